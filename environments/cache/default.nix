@@ -148,6 +148,7 @@ let
       lruLix
       openssh
       util-linuxMinimal
+      zstd # Decompressing pushed closures
       gnugrep
       getent
       doggo
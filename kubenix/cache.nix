@@ -19,6 +19,14 @@ in
       type = lib.types.int;
       default = 2222;
     };
+    pull = lib.mkOption {
+      description = ''
+        Nodes ask the cache to pull built paths from them, the cache signs
+        them with cacheSecretKey so nodes don't need to trust the cache
+      '';
+      type = lib.types.bool;
+      default = false;
+    };
   };
   config =
     let
@@ -30,6 +38,7 @@ in
     lib.mkIf (cfg.enable && cfg.cache.enable) {
       kubernetes.resources.${cfg.namespace} = {
         ConfigMap.authorized-keys.data.authorized_keys = lib.concatLines cfg.authorizedKeys;
+        Secret.cache-signing-key.stringData.secret-key = cfg.cacheSecretKey;
         StatefulSet.nix-cache = {
           spec = {
             serviceName = "nix-cache";
@@ -44,6 +53,7 @@ in
                   // nsRes.ConfigMap.nix-cache or { }
                   // nsRes.Secret.ssh-config or { }
                   // nsRes.Secret.authorized-keys or { }
+                  // nsRes.Secret.cache-signing-key or { }
                 );
               };
               spec = {
@@ -76,13 +86,16 @@ in
                       HOME.value = "/nix/var/nix-csi/root";
                       KUBE_NAMESPACE.valueFrom.fieldRef.fieldPath = "metadata.namespace";
                       BUILDERS_SERVICE_NAME.value = cfg.internalServiceName;
+                      NIX_CACHE_SECRET_KEY.value = "/etc/nix-cache/secret-key";
                     };
                     ports = lib.mkNamedList {
                       ssh.containerPort = 22;
                       http.containerPort = 80;
+                      pull.containerPort = 8181;
                     };
                     volumeMounts = lib.mkNamedList {
                       nix-config.mountPath = "/etc/nix";
+                      cache-signing-key.mountPath = "/etc/nix-cache";
                       ssh-config.mountPath = "/etc/ssh";
                       authorized-keys.mountPath = "/etc/authorized_keys";
                       nix-store = {
@@ -102,6 +115,10 @@ in
                     secretName = "authorized-keys";
                     defaultMode = 292; # 444
                   };
+                  cache-signing-key.secret = {
+                    secretName = "cache-signing-key";
+                    defaultMode = 256; # 400
+                  };
                   init-store.csi = {
                     driver = "nix.csi.store";
                     volumeAttributes = {
@@ -141,6 +158,14 @@ in
                 port = 22;
                 targetPort = "ssh";
               };
+              pull = {
+                port = 8181;
+                targetPort = "pull";
+              };
+              http = {
+                port = 80;
+                targetPort = "http";
+              };
             };
             type = "ClusterIP";
           };
@@ -125,9 +125,15 @@ in
         };
       in
       {
-        nixNodeConfig.settings = sharedSettings // {
-          keep-outputs = true; # Remove when we have separate builders
-        };
+        nixNodeConfig.settings =
+          sharedSettings
+          // {
+            keep-outputs = true; # Remove when we have separate builders
+          }
+          // lib.optionalAttrs cfg.cache.pull {
+            # Paths pulled by the cache are signed, nodes don't trust the cache
+            extra-trusted-public-keys = [ cfg.cachePublicKey ];
+          };
         nixCacheConfig.settings = sharedSettings // {
           max-jobs = lib.mkDefault 0;
         };
@@ -26,7 +26,10 @@ in
             };
             selector.matchLabels = labels;
             template = {
-              metadata.labels = labels;
+              # nix-csi-node is what builder discovery selects on
+              metadata.labels = labels // {
+                app = "nix-csi-node";
+              };
               metadata.annotations = {
                 "kubectl.kubernetes.io/default-container" = "nix-node";
                 configHash = lib.hashAttrs (
@@ -81,8 +84,10 @@ in
                     securityContext.privileged = true;
                     env =
                       lib.mkNamedList {
+                        CACHE_PULL.value = lib.boolToString (cfg.cache.enable && cfg.cache.pull);
                         CSI_ENDPOINT.value = "unix:///csi/csi.sock";
                         HOME.value = "/nix/var/nix-csi/root";
+                        KUBE_NAMESPACE.valueFrom.fieldRef.fieldPath = "metadata.namespace";
                         KUBE_NODE_NAME.valueFrom.fieldRef.fieldPath = "spec.nodeName";
                         KUBE_POD_IP.valueFrom.fieldRef.fieldPath = "status.podIP";
                         USER.value = "root";
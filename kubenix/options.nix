@@ -27,6 +27,18 @@ let
         mkdir -p $out
         ssh-keygen -t ed25519 -N "" -f $out/id_ed25519 -C "nix-csi-fallback-insecure"
       '';
+
+  signingKeyDrv =
+    pkgs.runCommand "nix-csi-cache-signing-key"
+      {
+        nativeBuildInputs = [ pkgs.lix ];
+      }
+      ''
+        export HOME=$TMPDIR
+        mkdir -p $out
+        nix --extra-experimental-features nix-command key generate-secret --key-name nix-csi-cache-fallback-insecure > $out/secret-key
+        nix --extra-experimental-features nix-command key convert-secret-to-public < $out/secret-key > $out/public-key
+      '';
 in
 {
   options.nix-csi = {
@@ -55,6 +67,16 @@ in
       type = lib.types.str;
       default = builtins.readFile "${keyDrv}/id_ed25519";
     };
+    cacheSecretKey = lib.mkOption {
+      description = "Nix secret key the cache signs pulled paths with";
+      type = lib.types.str;
+      default = builtins.readFile "${signingKeyDrv}/secret-key";
+    };
+    cachePublicKey = lib.mkOption {
+      description = "Nix public key nodes trust cache paths signed with";
+      type = lib.types.str;
+      default = builtins.readFile "${signingKeyDrv}/public-key";
+    };
     version = lib.mkOption {
       type = lib.types.str;
       default =
@@ -23,6 +23,12 @@ in
               IdentitiesOnly yes
               # UserKnownHostsFile /etc/ssh/known_hosts
               StrictHostKeyChecking yes
+          # Builder pods, addressed by pod IP
+          Host *
+              User nix
+              IdentityFile /etc/ssh/id_ed25519
+              IdentitiesOnly yes
+              StrictHostKeyChecking yes
         '';
         "ssh_known_hosts" = "* ${cfg.pubKey}";
         "sshd_config" = ''
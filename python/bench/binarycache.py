@@ -0,0 +1,236 @@
+#! /usr/bin/env python3
+
+# Substitute a synthetic store from the nix-cache binary cache over HTTP
+# with many clients at once, checking every NAR against its narinfo. NARs
+# nobody asked for before are streamed while they're compressed.
+#
+#   python bench/binarycache.py --clients 32
+
+import argparse
+import asyncio
+import hashlib
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+import fakestore  # noqa: E402
+from nix_cache.binarycache import BinaryCache  # noqa: E402
+from nix_csi import daemon  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="nix-cache binary cache benchmark")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--closures", type=int, default=4)
+    parser.add_argument("--paths-per-closure", type=int, default=50)
+    parser.add_argument("--files-per-path", type=int, default=20)
+    parser.add_argument("--file-size", type=int, default=16384)
+    parser.add_argument("--shared-paths", type=int, default=25)
+    parser.add_argument("--stream-size", type=int, default=64 * 1024**2)
+    return parser.parse_args()
+
+
+class Client:
+    """HTTP/1.1 client on one keep-alive connection, like Nix's curl."""
+
+    def __init__(self, port: int):
+        self.port = port
+        self.conn: tuple[asyncio.StreamReader, asyncio.StreamWriter] | None = None
+
+    async def get(self, target: str, **headers: str) -> tuple[int, dict, bytes]:
+        if self.conn is None:
+            self.conn = await asyncio.open_connection("127.0.0.1", self.port)
+        reader, writer = self.conn
+        lines = [f"GET {target} HTTP/1.1", "Host: nix-cache"]
+        lines += [f"{k.replace('_', '-')}: {v}" for k, v in headers.items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode())
+        await writer.drain()
+        status = int((await reader.readline()).split()[1])
+        response = {}
+        while (line := await reader.readline()) not in [b"\r\n", b""]:
+            name, _, value = line.decode().partition(":")
+            response[name.strip().lower()] = value.strip()
+        if response.get("transfer-encoding") == "chunked":
+            body = b""
+            while size := int((await reader.readline()).strip(), 16):
+                body += await reader.readexactly(size)
+                await reader.readline()
+            await reader.readline()
+        else:
+            body = await reader.readexactly(int(response.get("content-length", 0)))
+        return status, response, body
+
+    def close(self):
+        if self.conn is not None:
+            self.conn[1].close()
+
+
+def report(name: str, samples: list[float], elapsed: float, size: int = 0):
+    samples = sorted(samples)
+    print(
+        f"{name:>14}: n={len(samples)} "
+        f"p50={samples[len(samples) // 2] * 1000:.1f}ms "
+        f"p99={samples[min(len(samples) * 99 // 100, len(samples) - 1)] * 1000:.1f}ms "
+        f"mean={statistics.fmean(samples) * 1000:.1f}ms "
+        + (f"{size / elapsed / 1024**2:.1f}MiB/s" if size else "")
+    )
+
+
+def narinfo_fields(body: bytes) -> dict[str, str]:
+    return dict(line.split(": ", 1) for line in body.decode().splitlines())
+
+
+async def async_main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory(prefix="nix-cache-bench-") as tmp:
+        root = Path(tmp)
+        fake = fakestore.make_store(
+            root,
+            closures=args.closures,
+            paths_per_closure=args.paths_per_closure,
+            files_per_path=args.files_per_path,
+            file_size=args.file_size,
+            shared_paths=args.shared_paths,
+        )
+        daemonServer = await fakestore.serve_daemon(fake, root / "daemon.sock")
+        daemon.pool = daemon.DaemonPool(root / "daemon.sock")
+        cache = BinaryCache(root / "nar")
+        server = await cache.serve(port=0, host="127.0.0.1")
+        port = server.sockets[0].getsockname()[1]
+        print(f"{len(fake.graph)} paths, compression {cache.compression}")
+
+        paths = sorted(fake.graph)
+        clients = [Client(port) for _ in range(args.clients)]
+        errors = 0
+
+        async def fetch_all(fetch) -> tuple[list[float], float, int]:
+            """Every client fetches every path, like nodes substituting."""
+            samples: list[float] = []
+            size = 0
+
+            async def run(client: Client):
+                nonlocal size, errors
+                for path in paths:
+                    start = time.perf_counter()
+                    try:
+                        size += await fetch(client, path)
+                    except (AssertionError, OSError, ValueError) as ex:
+                        errors += 1
+                        print(f"{path}: {ex!r}", file=sys.stderr)
+                    samples.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            await asyncio.gather(*[run(c) for c in clients])
+            return samples, time.perf_counter() - start, size
+
+        infos: dict[str, dict[str, str]] = {}
+
+        async def narinfo(client: Client, path: str) -> int:
+            status, _, body = await client.get(f"/{Path(path).name[:32]}.narinfo")
+            assert status == 200, status
+            infos[path] = narinfo_fields(body)
+            return len(body)
+
+        verified: set[str] = set()
+
+        async def nar(client: Client, path: str) -> int:
+            info = infos[path]
+            status, _, body = await client.get(f"/{info['URL']}")
+            assert status == 200, status
+            # Checking once is enough, decompressing would dominate otherwise
+            if path in verified:
+                return len(body)
+            verified.add(path)
+            data = body
+            if info["Compression"] == "zstd":
+                data = (
+                    await asyncio.to_thread(
+                        subprocess.run,
+                        ["zstd", "-d", "-c"],
+                        input=body,
+                        capture_output=True,
+                        check=True,
+                    )
+                ).stdout
+            digest = hashlib.sha256(data).hexdigest()
+            assert f"sha256:{digest}" == info["NarHash"], "NAR hash mismatch"
+            assert len(data) == int(info["NarSize"]), "NAR size mismatch"
+            return len(body)
+
+        status, _, body = await clients[0].get("/nix-cache-info")
+        assert status == 200 and b"StoreDir: /nix/store" in body
+        status, _, _ = await clients[0].get(f"/{'0' * 32}.narinfo")
+        assert status == 404, status
+
+        samples, elapsed, _ = await fetch_all(narinfo)
+        report("narinfo cold", samples, elapsed)
+        samples, elapsed, _ = await fetch_all(narinfo)
+        report("narinfo warm", samples, elapsed)
+        samples, elapsed, size = await fetch_all(nar)
+        report("nar", samples, elapsed, size)
+
+        # Resumed download of a NAR
+        path = paths[-1]
+        status, _, full = await clients[0].get(f"/{infos[path]['URL']}")
+        status, headers, part = await clients[0].get(
+            f"/{infos[path]['URL']}", Range="bytes=100-"
+        )
+        assert status == 206 and part == full[100:], "range mismatch"
+        assert headers["content-range"] == f"bytes 100-{len(full) - 1}/{len(full)}"
+
+        # A large path nobody asked for, streamed while it's compressed
+        large = fake.store / fakestore.store_name("large")
+        large.mkdir()
+        (large / "file").write_bytes(os.urandom(args.stream_size))
+        fake.graph[str(large)] = []
+        await narinfo(clients[0], str(large))
+        start = time.perf_counter()
+        url = f"/{infos[str(large)]['URL']}"
+        status, headers, streamed = await clients[0].get(url)
+        elapsed = time.perf_counter() - start
+        assert status == 200, status
+        assert headers.get("transfer-encoding") == "chunked", "NAR wasn't streamed"
+        await nar(clients[1], str(large))
+        _, _, served = await clients[1].get(url)
+        assert streamed == served, "streamed NAR mismatch"
+        print(
+            f"{'nar streamed':>14}: {len(streamed) / 1024**2:.1f}MiB "
+            f"in {elapsed * 1000:.1f}ms"
+        )
+
+        # A path that disappeared can't be compressed
+        coldCache = BinaryCache(root / "nar-cold")
+        coldServer = await coldCache.serve(port=0, host="127.0.0.1")
+        cold = Client(coldServer.sockets[0].getsockname()[1])
+
+        gone = paths[0]
+        shutil.rmtree(gone)
+        status, _, _ = await cold.get(f"/{infos[gone]['URL']}")
+        assert status == 500, status
+        leftovers = [p.name for p in (root / "nar-cold").iterdir()]
+        assert not any(name.endswith(".tmp") for name in leftovers), leftovers
+        print(f"{'nar failed':>14}: {status}, no temporary files left")
+        print(f"{'errors':>14}: {errors}")
+        cold.close()
+
+        for client in clients:
+            client.close()
+        # Let the server see the clients hang up
+        await asyncio.sleep(0.1)
+        server.close()
+        coldServer.close()
+        daemonServer.close()
+
+
+def main():
+    asyncio.run(async_main())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+#! /usr/bin/env python3
+
+# Fake builder nodes, each a local store directory with a load average,
+# behind ssh and nix shims. Checks which builder NodeServicer offloads to,
+# that load queries are cached, and that failed or missing builders fall
+# back to building locally.
+#
+#   python bench/builders.py --builders 4 --publishes 200
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import textwrap
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+from nix_csi import builders  # noqa: E402
+from nix_csi.service import NodeServicer  # noqa: E402
+
+SYSTEM = "x86_64-linux"
+
+# Answers `ssh nix@<ip> -- cat /proc/loadavg && nproc` from the builder's
+# directory, counting queries. Unreachable if there's no such builder.
+SSH_SHIM = """
+    for arg; do case "$arg" in nix@*) ip="${arg#nix@}" ;; esac; done
+    dir="$BENCH_BUILDERS/$ip"
+    [ -f "$dir/loadavg" ] || exit 255
+    echo >> "$dir/queries"
+    cat "$dir/loadavg"
+    cat "$dir/nproc" 2>/dev/null || echo 1
+"""
+
+# nix build with --builders builds into that builder's store, otherwise into
+# the local one. The out link names what was built.
+NIX_SHIM = """
+    dir="$BENCH_BUILDERS/local"
+    while [ $# -gt 0 ]; do
+        case "$1" in
+            --builders) ip="${2#ssh-ng://nix@}"; ip="${ip%%\\?*}"
+                        dir="$BENCH_BUILDERS/$ip"; shift ;;
+            --out-link) name="$2"; shift ;;
+        esac
+        shift
+    done
+    [ -f "$dir/broken" ] && exit 1
+    mkdir -p "$dir/store" && touch "$dir/store/${name##*/}"
+"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="nix-csi build offload harness")
+    parser.add_argument("--builders", type=int, default=4)
+    parser.add_argument("--publishes", type=int, default=100)
+    return parser.parse_args()
+
+
+def write_shims(bin: Path):
+    bin.mkdir(parents=True, exist_ok=True)
+    for name, body in {"ssh": SSH_SHIM, "nix": NIX_SHIM}.items():
+        shim = bin / name
+        shim.write_text("#! /bin/sh\n" + textwrap.dedent(body).strip() + "\n")
+        shim.chmod(0o755)
+
+
+def built_on(root: Path, name: str) -> list[str]:
+    return sorted(d.name for d in root.iterdir() if (d / "store" / name).exists())
+
+
+async def async_main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory(prefix="nix-csi-builders-") as tmp:
+        root = Path(tmp)
+        write_shims(root / "bin")
+        os.environ["PATH"] = f"{root / 'bin'}:{os.environ['PATH']}"
+        os.environ["BENCH_BUILDERS"] = str(root)
+        os.environ["KUBE_NAMESPACE"] = "bench"
+
+        # Builder i has load i/2 per CPU, the first one is idle
+        ips = [f"10.0.0.{i + 1}" for i in range(args.builders)]
+        for i, ip in enumerate(ips):
+            (root / ip).mkdir()
+            (root / ip / "loadavg").write_text(f"{i / 2:.2f} 0.00 0.00 1/1 1\n")
+        (root / "local").mkdir()
+        builders.builderCache[SYSTEM] = (time.monotonic() + 3600, ips)
+
+        node = NodeServicer(SYSTEM)
+        failed = 0
+
+        def check(name: str, ok: bool, detail: object = ""):
+            nonlocal failed
+            failed += not ok
+            print(f"{name:>24}: {'ok' if ok else 'FAILED'} {detail}")
+
+        picked = await builders.pick_builder(SYSTEM)
+        check("least loaded", picked == ips[0], picked)
+
+        # Builds already sent to a builder count against it
+        async with builders.remote_build_args(SYSTEM) as first:
+            async with builders.remote_build_args(SYSTEM) as second:
+                check("in-flight spreads", first != second, [first[1], second[1]])
+
+        await node.nix_build("--out-link", root / "out-idle", "pkg-idle")
+        check("offloaded", built_on(root, "out-idle") == [ips[0]])
+
+        # Many publishes, loads are queried once per TTL
+        start = time.perf_counter()
+        await asyncio.gather(
+            *[builders.pick_builder(SYSTEM) for _ in range(args.publishes)]
+        )
+        elapsed = time.perf_counter() - start
+        queries = sum(
+            len((root / ip / "queries").read_text().splitlines()) for ip in ips
+        )
+        check(
+            "cached loads",
+            queries == len(ips),
+            f"{queries} ssh for {args.publishes + 3} picks in {elapsed * 1000:.0f}ms",
+        )
+
+        # One build in flight on an idle 32 CPU builder is less than half
+        # the load of a 1 CPU builder
+        (root / ips[0] / "nproc").write_text("32\n")
+        builders.loadCache.clear()
+        async with builders.remote_build_args(SYSTEM):
+            picked = await builders.pick_builder(SYSTEM)
+        check("in-flight per CPU", picked == ips[0], picked)
+
+        # A broken builder falls back to a local build
+        (root / ips[0] / "broken").touch()
+        await node.nix_build("--out-link", root / "out-broken", "pkg-broken")
+        check("broken falls back", built_on(root, "out-broken") == ["local"])
+
+        # No reachable builders builds locally right away
+        for ip in ips:
+            (root / ip / "loadavg").unlink()
+        builders.loadCache.clear()
+        check("no builders", await builders.pick_builder(SYSTEM) is None)
+        await node.nix_build("--out-link", root / "out-none", "pkg-none")
+        check("builds locally", built_on(root, "out-none") == ["local"])
+
+        if failed:
+            sys.exit(1)
+
+
+def main():
+    asyncio.run(async_main())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+#! /usr/bin/env python3
+
+# Synthetic Nix store, fake nix-daemon and command shims for benchmarking
+# nix-csi without Nix, a cluster or root.
+
+import asyncio
+import hashlib
+import os
+import struct
+import textwrap
+from pathlib import Path
+from typing import NamedTuple
+
+from nix_cache import nar
+from nix_csi import daemon
+
+
+class FakeStore(NamedTuple):
+    root: Path
+    store: Path
+    # closure roots, one per closure
+    roots: list[str]
+    # store path -> references
+    graph: dict[str, list[str]]
+
+
+def store_name(seed: str) -> str:
+    digest = hashlib.sha256(seed.encode()).hexdigest()[:32]
+    return f"{digest}-{seed}"
+
+
+def make_store(
+    root: Path,
+    closures: int = 4,
+    paths_per_closure: int = 50,
+    files_per_path: int = 20,
+    file_size: int = 4096,
+    shared_paths: int = 25,
+) -> FakeStore:
+    """Fill root/nix/store with closures sharing shared_paths paths."""
+    store = root / "nix/store"
+    store.mkdir(parents=True, exist_ok=True)
+    graph: dict[str, list[str]] = {}
+
+    def add_path(seed: str, references: list[str]) -> str:
+        path = store / store_name(seed)
+        path.mkdir(exist_ok=True)
+        for i in range(files_per_path):
+            (path / f"file{i}").write_bytes(os.urandom(file_size))
+        graph[str(path)] = references
+        return str(path)
+
+    shared = [add_path(f"shared{i}", []) for i in range(shared_paths)]
+    roots = []
+    for c in range(closures):
+        own = [
+            add_path(f"closure{c}-path{i}", shared)
+            for i in range(max(paths_per_closure - shared_paths - 1, 0))
+        ]
+        roots.append(add_path(f"closure{c}-root", own + shared))
+    return FakeStore(root, store, roots, graph)
+
+
+def make_shims(bin: Path, system: str = "x86_64-linux", real_mounts: bool = False):
+    """Commands NodeServicer shells out to, doing the least they can."""
+    bin.mkdir(parents=True, exist_ok=True)
+    shims = {
+        # eval prints the system, build/copy succeed without doing anything
+        "nix": f"""
+            [ "$1" = eval ] && printf %s {system}
+            exit 0
+        """,
+        "nix_init_db": """
+            mkdir -p "$1/db" && touch "$1/db/db.sqlite"
+        """,
+        "ssh": "exit 255",
+    }
+    if not real_mounts:
+        shims |= {
+            # Nothing is ever mounted
+            "mount": "exit 0",
+            "umount": "exit 0",
+            "findmnt": "exit 1",
+            # The image is the last argument
+            "mkcomposefs": 'for last; do :; done; touch "$last"',
+        }
+    for name, body in shims.items():
+        shim = bin / name
+        shim.write_text("#! /bin/sh\n" + textwrap.dedent(body).strip() + "\n")
+        shim.chmod(0o755)
+
+
+def _int(value: int) -> bytes:
+    return struct.pack("<Q", value)
+
+
+def _str(value: str) -> bytes:
+    data = value.encode()
+    return _int(len(data)) + data + b"\0" * (-len(data) % 8)
+
+
+async def serve_daemon(fake: FakeStore, sock: Path):
+    """Serve path infos of fake over the nix-daemon worker protocol."""
+
+    # store path -> (NAR hash, NAR size), for fakes served as binary caches
+    nars: dict[str, tuple[str, int]] = {}
+
+    def nar_info(path: str) -> tuple[str, int]:
+        if path not in nars:
+            digest = hashlib.sha256()
+            size = 0
+
+            def write(data: bytes):
+                nonlocal size
+                digest.update(data)
+                size += len(data)
+
+            nar.dump(Path(path), write)
+            nars[path] = (digest.hexdigest(), size)
+        return nars[path]
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        async def read_int() -> int:
+            return struct.unpack("<Q", await reader.readexactly(8))[0]
+
+        async def read_str() -> str:
+            length = await read_int()
+            return (await reader.readexactly(length + (-length % 8)))[:length].decode()
+
+        try:
+            await read_int()
+            writer.write(_int(daemon.WORKER_MAGIC_2) + _int(daemon.PROTOCOL_VERSION))
+            await read_int()  # client version
+            await read_int()  # affinity
+            await read_int()  # reserveSpace
+            writer.write(_str("fakestore") + _int(1) + _int(daemon.STDERR_LAST))
+            await writer.drain()
+            while True:
+                op = await read_int()
+                path = await read_str()
+                writer.write(_int(daemon.STDERR_LAST))
+                if op == daemon.WOP_QUERY_PATH_INFO:
+                    if path not in fake.graph:
+                        writer.write(_int(0))
+                    else:
+                        refs = fake.graph[path]
+                        narHash, narSize = nar_info(path)
+                        writer.write(
+                            _int(1)
+                            + _str("")
+                            + _str(narHash)
+                            + _int(len(refs))
+                            + b"".join(_str(r) for r in refs)
+                            + _int(0)
+                            + _int(narSize)
+                            + _int(0)
+                            + _int(0)
+                            + _str("")
+                        )
+                elif op == daemon.WOP_IS_VALID_PATH:
+                    writer.write(_int(int(path in fake.graph)))
+                elif op == daemon.WOP_QUERY_PATH_FROM_HASH_PART:
+                    # path is the hash part here
+                    matches = [p for p in fake.graph if Path(p).name[:32] == path]
+                    writer.write(_str(matches[0] if matches else ""))
+                else:
+                    writer.write(_int(1))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            writer.close()
+
+    return await asyncio.start_unix_server(handle, str(sock))
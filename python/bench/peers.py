@@ -0,0 +1,132 @@
+#! /usr/bin/env python3
+
+# Two synthetic stores standing in for nodes, each with its own fake
+# nix-daemon and store index, queried the way NodePublishVolume picks peer
+# substituters.
+#
+#   python bench/peers.py --queries 2000
+
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+import fakestore  # noqa: E402
+from nix_csi import daemon, peers  # noqa: E402
+
+# Nodes are told apart by address, so both indexes can share a port
+NODE_IPS = ["127.0.0.2", "127.0.0.3"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="nix-csi peer index benchmark")
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--closures", type=int, default=4)
+    parser.add_argument("--paths-per-closure", type=int, default=50)
+    parser.add_argument("--shared-paths", type=int, default=25)
+    return parser.parse_args()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind((NODE_IPS[0], 0))
+        return sock.getsockname()[1]
+
+
+async def async_main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory(prefix="nix-csi-peers-") as tmp:
+        port = free_port()
+        nodes = []
+        servers = []
+        for i, ip in enumerate(NODE_IPS):
+            root = Path(tmp) / f"node{i}"
+            root.mkdir()
+            # The second node only has what every closure shares
+            fake = fakestore.make_store(
+                root,
+                closures=args.closures if i == 0 else 0,
+                paths_per_closure=args.paths_per_closure,
+                files_per_path=1,
+                file_size=64,
+                shared_paths=args.shared_paths,
+            )
+            servers.append(await fakestore.serve_daemon(fake, root / "daemon.sock"))
+            pool = daemon.DaemonPool(root / "daemon.sock")
+            servers.append(
+                await peers.serve_index(fake.store, port=port, host=ip, pool=pool)
+            )
+            nodes.append(fake)
+        full, partial = nodes
+
+        # A directory nobody registered, like a crashed substitution
+        root = Path(full.roots[0])
+        (partial.store / root.name).mkdir()
+
+        checks = {
+            "root on full node": (NODE_IPS[0], root, True),
+            "root on partial node": (NODE_IPS[1], root, False),
+            "shared on partial node": (
+                NODE_IPS[1],
+                Path(next(p for p in partial.graph)),
+                True,
+            ),
+            "unknown path": (NODE_IPS[0], Path("/nix/store/" + "0" * 32 + "-x"), False),
+        }
+        failed = 0
+        for name, (ip, path, expected) in checks.items():
+            held = await peers.peer_has(ip, path, port)
+            ok = held == expected
+            failed += not ok
+            print(f"{name:>24}: {'ok' if ok else 'FAILED'}")
+
+        # Substituter selection against both nodes
+        os.environ["KUBE_NAMESPACE"] = "bench"
+        peers.peerCache = (time.monotonic() + 3600, NODE_IPS)
+        substituters = await peers.peer_substituters(root, port)
+        ok = len(substituters) == 2 and NODE_IPS[0] in substituters[1]
+        failed += not ok
+        print(f"{'substituters':>24}: {'ok' if ok else 'FAILED'} {substituters}")
+
+        # Query latency, every publish asks every peer once
+        paths = [Path(p) for p in full.graph]
+        limit = asyncio.Semaphore(args.concurrency)
+        samples: list[float] = []
+
+        async def query(i: int):
+            async with limit:
+                start = time.perf_counter()
+                await peers.peer_has(NODE_IPS[i % 2], paths[i % len(paths)], port)
+                samples.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[query(i) for i in range(args.queries)])
+        elapsed = time.perf_counter() - start
+        samples.sort()
+        print(
+            f"{'queries':>24}: n={len(samples)} "
+            f"p50={samples[len(samples) // 2] * 1000:.1f}ms "
+            f"p99={samples[min(len(samples) * 99 // 100, len(samples) - 1)] * 1000:.1f}ms "
+            f"mean={statistics.fmean(samples) * 1000:.1f}ms "
+            f"throughput={len(samples) / elapsed:.0f}/s"
+        )
+
+        for server in servers:
+            server.close()
+        if failed:
+            sys.exit(1)
+
+
+def main():
+    asyncio.run(async_main())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+#! /usr/bin/env python3
+
+# Drive NodePublishVolume/NodeUnpublishVolume storms against the real CSI
+# server on a temporary socket, backed by a synthetic store.
+#
+#   python bench/publish.py --volumes 200 --concurrency 32
+#
+# Comparing backends by latency and kernel memory with real mounts (root):
+#
+#   python bench/publish.py --hold --real-mounts --backend rsync
+#   python bench/publish.py --hold --real-mounts --backend composefs
+
+import argparse
+import asyncio
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from csi import csi_grpc, csi_pb2
+from grpclib import GRPCError
+from grpclib.client import Channel
+from grpclib.const import Status
+
+# No cluster to find peers or builders in, random port for the store index
+os.environ["PEER_PORT"] = "0"
+os.environ.pop("KUBE_NAMESPACE", None)
+os.environ.pop("CACHE_ENABLED", None)
+
+sys.path.insert(0, str(Path(__file__).parent))
+import fakestore  # noqa: E402
+from nix_csi import daemon, service  # noqa: E402
+
+SYSTEM = "x86_64-linux"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="nix-csi publish benchmark")
+    parser.add_argument("--volumes", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--closures", type=int, default=4)
+    parser.add_argument("--paths-per-closure", type=int, default=50)
+    parser.add_argument("--files-per-path", type=int, default=20)
+    parser.add_argument("--file-size", type=int, default=4096)
+    parser.add_argument("--shared-paths", type=int, default=25)
+    parser.add_argument(
+        "--readonly-ratio",
+        type=float,
+        default=0.5,
+        help="Fraction of volumes published readonly",
+    )
+    parser.add_argument(
+        "--backend",
+        default="rsync",
+        choices=service.BACKENDS,
+        help="Volume backend to publish with",
+    )
+    parser.add_argument(
+        "--hold",
+        action="store_true",
+        help="Publish all volumes before unpublishing, reporting kernel memory "
+        "and volume stats latency",
+    )
+    parser.add_argument(
+        "--real-mounts",
+        action="store_true",
+        help="Really mount volumes (and loop mount composefs images), needs root",
+    )
+    parser.add_argument(
+        "--republish",
+        action="store_true",
+        help="Publish every volume twice, timing the repeated publish",
+    )
+    parser.add_argument(
+        "--backoff",
+        type=float,
+        default=0.5,
+        help="Initial retry delay (seconds) after RESOURCE_EXHAUSTED",
+    )
+    parser.add_argument(
+        "--volume-attribute",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="Extra volume attribute added to every volume",
+    )
+    return parser.parse_args()
+
+
+def percentile(samples: list[float], pct: float) -> float:
+    if len(samples) == 0:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * pct / 100), len(samples) - 1)]
+
+
+def report(name: str, samples: list[float], elapsed: float):
+    print(
+        f"{name:>10}: n={len(samples)} "
+        f"p50={percentile(samples, 50) * 1000:.1f}ms "
+        f"p99={percentile(samples, 99) * 1000:.1f}ms "
+        f"mean={statistics.fmean(samples) * 1000 if samples else 0:.1f}ms "
+        f"throughput={len(samples) / elapsed if elapsed else 0:.1f}/s"
+    )
+
+
+def kernel_memory() -> dict[str, int]:
+    """Slab memory (KiB) and dentry/inode counts of the running kernel."""
+    stats = {}
+    for line in Path("/proc/meminfo").read_text().splitlines():
+        key, value = line.split(":", 1)
+        if key in ["Slab", "SReclaimable", "SUnreclaim"]:
+            stats[key] = int(value.split()[0])
+    stats["dentries"] = int(Path("/proc/sys/fs/dentry-state").read_text().split()[0])
+    stats["inodes"] = int(Path("/proc/sys/fs/inode-nr").read_text().split()[0])
+    return stats
+
+
+async def storm(args, fake: fakestore.FakeStore, sock: Path):
+    channel = Channel(path=str(sock))
+    node = csi_grpc.NodeStub(channel)
+    limit = asyncio.Semaphore(args.concurrency)
+    extra = dict(kv.split("=", 1) for kv in args.volume_attribute)
+    extra["backend"] = args.backend
+    publish: list[float] = []
+    republish: list[float] = []
+    unpublish: list[float] = []
+    stats: list[float] = []
+    statsCached: list[float] = []
+    errors = 0
+    rejected = 0
+
+    def target(i: int) -> Path:
+        return fake.root / f"kubelet/pods/{i}/volumes/nix"
+
+    async def publish_one(i: int, samples: list[float] = publish):
+        nonlocal errors, rejected
+        readonly = i < args.volumes * args.readonly_ratio
+        context = {SYSTEM: fake.roots[i % len(fake.roots)], **extra}
+        backoff = args.backoff
+        try:
+            start = time.perf_counter()
+            while True:
+                try:
+                    await node.NodePublishVolume(
+                        csi_pb2.NodePublishVolumeRequest(
+                            volume_id=f"csi-bench-{i}",
+                            target_path=str(target(i)),
+                            readonly=readonly,
+                            volume_context=context,
+                        )
+                    )
+                    break
+                except GRPCError as ex:
+                    if ex.status != Status.RESOURCE_EXHAUSTED:
+                        raise
+                    # Like kubelet, back off exponentially and try again
+                    rejected += 1
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, 30)
+            samples.append(time.perf_counter() - start)
+        except Exception as ex:
+            errors += 1
+            print(f"publish csi-bench-{i}: {ex}", file=sys.stderr)
+
+    async def unpublish_one(i: int):
+        nonlocal errors
+        try:
+            start = time.perf_counter()
+            await node.NodeUnpublishVolume(
+                csi_pb2.NodeUnpublishVolumeRequest(
+                    volume_id=f"csi-bench-{i}", target_path=str(target(i))
+                )
+            )
+            unpublish.append(time.perf_counter() - start)
+        except Exception as ex:
+            errors += 1
+            print(f"unpublish csi-bench-{i}: {ex}", file=sys.stderr)
+
+    async def stats_one(i: int, samples: list[float]):
+        nonlocal errors
+        try:
+            start = time.perf_counter()
+            await node.NodeGetVolumeStats(
+                csi_pb2.NodeGetVolumeStatsRequest(
+                    volume_id=f"csi-bench-{i}", volume_path=str(target(i))
+                )
+            )
+            samples.append(time.perf_counter() - start)
+        except Exception as ex:
+            errors += 1
+            print(f"stats csi-bench-{i}: {ex}", file=sys.stderr)
+
+    async def cycle(i: int):
+        async with limit:
+            await publish_one(i)
+            if args.republish:
+                await publish_one(i, republish)
+            await unpublish_one(i)
+
+    async def limited(fn, i: int):
+        async with limit:
+            await fn(i)
+
+    volumes = range(args.volumes)
+    start = time.perf_counter()
+    if args.hold:
+        # Everything published at once, like a node full of pods
+        before = kernel_memory()
+        await asyncio.gather(*[limited(publish_one, i) for i in volumes])
+        after = kernel_memory()
+        # Kubelet polls stats of every volume, the second round is cached
+        for samples in [stats, statsCached]:
+            await asyncio.gather(
+                *[limited(lambda i: stats_one(i, samples), i) for i in volumes]
+            )
+        await asyncio.gather(*[limited(unpublish_one, i) for i in volumes])
+        for key in before:
+            print(f"{key:>12}: {after[key] - before[key]:+d}")
+    else:
+        await asyncio.gather(*[cycle(i) for i in volumes])
+    elapsed = time.perf_counter() - start
+    channel.close()
+
+    report("publish", publish, elapsed)
+    if args.republish:
+        report("republish", republish, elapsed)
+    report("unpublish", unpublish, elapsed)
+    if args.hold:
+        report("stats", stats, elapsed)
+        report("stats again", statsCached, elapsed)
+    print(f"{'errors':>10}: {errors}")
+    print(f"{'rejected':>10}: {rejected}")
+
+
+async def async_main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory(prefix="nix-csi-bench-") as tmp:
+        root = Path(tmp)
+        start = time.perf_counter()
+        fake = fakestore.make_store(
+            root,
+            closures=args.closures,
+            paths_per_closure=args.paths_per_closure,
+            files_per_path=args.files_per_path,
+            file_size=args.file_size,
+            shared_paths=args.shared_paths,
+        )
+        print(
+            f"Synthetic store: {len(fake.graph)} paths, "
+            f"{len(fake.graph) * args.files_per_path} files "
+            f"in {time.perf_counter() - start:.1f}s"
+        )
+
+        fakestore.make_shims(root / "bin", SYSTEM, args.real_mounts)
+        os.environ["PATH"] = f"{root / 'bin'}:{os.environ['PATH']}"
+
+        daemonSock = root / "daemon.sock"
+        daemonServer = await fakestore.serve_daemon(fake, daemonSock)
+        daemon.pool = daemon.DaemonPool(daemonSock)
+
+        service.CSI_ROOT = root / "nix/var/nix-csi"
+        service.CSI_VOLUMES = service.CSI_ROOT / "volumes"
+        service.CSI_GCROOTS = root / "nix/var/nix/gcroots/nix-csi"
+        service.CSI_SHARED = service.CSI_ROOT / "shared"
+
+        sock = root / "csi.sock"
+        server = asyncio.create_task(service.serve(str(sock)))
+        while not sock.exists():
+            await asyncio.sleep(0.01)
+
+        await storm(args, fake, sock)
+
+        server.cancel()
+        daemonServer.close()
+
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    print(
+        f"{'peak RSS':>10}: daemon={own / 1024:.1f}MiB children={children / 1024:.1f}MiB"
+    )
+
+
+def main():
+    asyncio.run(async_main())
+
+
+if __name__ == "__main__":
+    main()
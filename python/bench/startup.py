@@ -0,0 +1,119 @@
+#! /usr/bin/env python3
+
+# Time how long entry points take to import and how long the CSI server
+# takes from process start until its socket accepts connections and until
+# it answers Probe, which is what gates daemonset rollouts.
+#
+#   python bench/startup.py --runs 10
+
+import argparse
+import asyncio
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from csi import csi_grpc, csi_pb2
+from grpclib.client import Channel
+
+ENTRY_POINTS = ["nix_csi.cli", "nix_csi.service", "nix_cache.cli", "nix_timegc.cli"]
+
+# Runs the CSI server on a socket in a temporary root, no cluster and no peers
+SERVER = """
+import asyncio, os, sys
+from pathlib import Path
+os.environ["PEER_PORT"] = "0"
+os.environ.pop("KUBE_NAMESPACE", None)
+from nix_csi import service
+root = Path(sys.argv[1])
+service.CSI_ROOT = root / "nix/var/nix-csi"
+service.CSI_VOLUMES = service.CSI_ROOT / "volumes"
+service.CSI_GCROOTS = root / "nix/var/nix/gcroots/nix-csi"
+service.CSI_SHARED = service.CSI_ROOT / "shared"
+asyncio.run(service.serve(sys.argv[2]))
+"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="nix-csi startup benchmark")
+    parser.add_argument("--runs", type=int, default=10)
+    return parser.parse_args()
+
+
+def report(name: str, samples: list[float]):
+    print(
+        f"{name:>16}: min={min(samples) * 1000:.1f}ms "
+        f"median={statistics.median(samples) * 1000:.1f}ms "
+        f"max={max(samples) * 1000:.1f}ms"
+    )
+
+
+def time_import(module: str) -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", f"import {module}"], check=True)
+    return time.perf_counter() - start
+
+
+def connectable(path: Path) -> bool:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(str(path))
+            return True
+        except OSError:
+            return False
+
+
+async def time_server(root: Path) -> tuple[float, float]:
+    """Seconds until the socket is bound and until Probe is answered."""
+    sock = root / "csi.sock"
+    sock.unlink(missing_ok=True)
+    start = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "-c", SERVER, str(root), str(sock)
+    )
+    try:
+        while not connectable(sock):
+            if process.returncode is not None:
+                raise RuntimeError(f"server exited {process.returncode}")
+            await asyncio.sleep(0.001)
+        bound = time.perf_counter() - start
+        channel = Channel(path=str(sock))
+        await csi_grpc.IdentityStub(channel).Probe(csi_pb2.ProbeRequest())
+        ready = time.perf_counter() - start
+        channel.close()
+        return bound, ready
+    finally:
+        process.terminate()
+        await process.wait()
+
+
+async def async_main():
+    args = parse_args()
+    baseline = [time_import("sys") for _ in range(args.runs)]
+    report("interpreter", baseline)
+    for module in ENTRY_POINTS:
+        report(module, [time_import(module) for _ in range(args.runs)])
+
+    with tempfile.TemporaryDirectory(prefix="nix-csi-startup-") as tmp:
+        bound: list[float] = []
+        ready: list[float] = []
+        for _ in range(args.runs):
+            b, r = await time_server(Path(tmp))
+            bound.append(b)
+            ready.append(r)
+        report("socket bound", bound)
+        report("probe ready", ready)
+
+
+def main():
+    # Child interpreters import the same nix_csi as we do
+    os.environ["PYTHONPATH"] = os.pathsep.join(sys.path)
+    asyncio.run(async_main())
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@
   lib, # recursive update
   buildPythonApplication, # Builder
   hatchling, # Build system
+  composefs, # mkcomposefs, mount.composefs
   coreutils, # ln
   csi-proto-python, # CSI GRPC bindings
   gitMinimal, # Lix requires Git since it doesn't use libgit2
@@ -11,6 +12,7 @@
   openssh, # Copying to cache
   rsync, # hardlinking
   util-linuxMinimal, # mount, umount
+  zstd, # NAR compression in the binary cache and pushes to it
 }:
 let
   pyproject = builtins.fromTOML (builtins.readFile ./pyproject.toml);
@@ -21,6 +23,7 @@ let
     pyproject = true;
     build-system = [ hatchling ];
     dependencies = [
+      composefs
       coreutils
       csi-proto-python
       gitMinimal
@@ -30,6 +33,7 @@ let
       openssh
       rsync
       util-linuxMinimal
+      zstd
     ];
   };
 in
@@ -0,0 +1,406 @@
+import asyncio
+import logging
+import os
+import shutil
+import subprocess
+from collections import OrderedDict
+from pathlib import Path
+
+from nix_csi import daemon
+from nix_csi.daemon import PathInfo
+from . import nar
+
+# HTTP binary cache in front of the cache's store, so nodes substitute over
+# plain HTTP in parallel instead of queueing up on one SSH daemon. Path
+# infos come from nix-daemon and are kept in an LRU, NARs are compressed
+# once into NAR_DIR and served from there with sendfile. NARs still being
+# compressed are streamed to clients as they're written.
+
+logger = logging.getLogger("nix-csi")
+
+HTTP_PORT = int(os.environ.get("HTTP_PORT", "80"))
+NAR_DIR = Path(os.environ.get("NIX_CACHE_NAR_DIR", "/nix/var/nix-cache/nar"))
+# Compressed NARs kept on disk, least recently served are removed first
+NAR_DIR_MAX_BYTES = int(os.environ.get("NIX_CACHE_NAR_MAX_BYTES", 20 * 1024**3))
+# Path infos kept in memory
+NARINFO_CACHE_SIZE = 10000
+# NARs compressed at once
+COMPRESS_JOBS = 2
+ZSTD_LEVEL = 3
+# Idle keep-alive connections are closed after this long
+IDLE_TIMEOUT = 30.0
+# Streamed NARs are read this much at a time, waiting this long for more
+STREAM_CHUNK = 1024 * 1024
+STREAM_POLL = 0.05
+
+CACHE_INFO = b"StoreDir: /nix/store\nWantMassQuery: 1\nPriority: 30\n"
+
+REASONS = {
+    200: "OK",
+    206: "Partial Content",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    416: "Range Not Satisfiable",
+    500: "Internal Server Error",
+}
+
+
+def hash_part(path: str) -> str:
+    return Path(path).name[:32]
+
+
+def nar_digest(info: PathInfo) -> str:
+    """Hex NAR hash, the daemon sends it without algorithm (old ones with)."""
+    return info.narHash.removeprefix("sha256:")
+
+
+def parse_range(value: str, size: int) -> tuple[int, int] | None:
+    """First and last byte of a single `bytes=` range, None if unsatisfiable."""
+    unit, _, spec = value.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if first == "":
+            # Suffix range, the last n bytes
+            start, end = max(size - int(last), 0), size - 1
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last != "" else size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        return None
+    return start, end
+
+
+class BinaryCache:
+    def __init__(self, narDir: Path = NAR_DIR, maxBytes: int = NAR_DIR_MAX_BYTES):
+        self.narDir = narDir
+        self.maxBytes = maxBytes
+        self.compression = "zstd" if shutil.which("zstd") else "none"
+        # hash part -> path info, least recently used first
+        self.infos: OrderedDict[str, PathInfo] = OrderedDict()
+        # NAR file name -> compression in progress
+        self.compressing: dict[str, asyncio.Task] = {}
+        self.compressJobs = asyncio.Semaphore(COMPRESS_JOBS)
+
+    async def path_info(self, hashPart: str) -> PathInfo | None:
+        info = self.infos.get(hashPart)
+        if info is not None and os.path.lexists(info.path):
+            self.infos.move_to_end(hashPart)
+            return info
+        self.infos.pop(hashPart, None)
+        path = await daemon.query_path_from_hash_part(hashPart)
+        if path is None:
+            return None
+        info = await daemon.query_path_info(path)
+        if info is None:
+            return None
+        self.infos[hashPart] = info
+        while len(self.infos) > NARINFO_CACHE_SIZE:
+            self.infos.popitem(last=False)
+        return info
+
+    def nar_name(self, info: PathInfo) -> str:
+        suffix = ".nar.zst" if self.compression == "zstd" else ".nar"
+        return f"{hash_part(info.path)}-{nar_digest(info)}{suffix}"
+
+    def narinfo(self, info: PathInfo) -> bytes:
+        name = self.nar_name(info)
+        lines = [
+            f"StorePath: {info.path}",
+            f"URL: nar/{name}",
+            f"Compression: {self.compression}",
+        ]
+        if (self.narDir / name).exists():
+            lines.append(f"FileSize: {(self.narDir / name).stat().st_size}")
+        lines += [
+            f"NarHash: sha256:{nar_digest(info)}",
+            f"NarSize: {info.narSize}",
+            f"References: {' '.join(Path(r).name for r in sorted(info.references))}",
+        ]
+        if info.deriver is not None:
+            lines.append(f"Deriver: {Path(info.deriver).name}")
+        lines += [f"Sig: {sig}" for sig in info.sigs]
+        if info.ca is not None:
+            lines.append(f"CA: {info.ca}")
+        return ("\n".join(lines) + "\n").encode()
+
+    @staticmethod
+    def tmp_path(dest: Path) -> Path:
+        return dest.with_name(f".{dest.name}.{os.getpid()}.tmp")
+
+    def compress(self, info: PathInfo, dest: Path):
+        """Write the compressed NAR of info.path to dest, runs in a thread."""
+        tmp = self.tmp_path(dest)
+        try:
+            with open(tmp, "wb") as out:
+                if self.compression == "zstd":
+                    zstd = subprocess.Popen(
+                        ["zstd", "--quiet", f"-{ZSTD_LEVEL}", "-T0", "-c"],
+                        stdin=subprocess.PIPE,
+                        stdout=out,
+                    )
+                    assert zstd.stdin is not None
+                    try:
+                        nar.dump(Path(info.path), zstd.stdin.write)
+                        zstd.stdin.close()
+                    except BaseException:
+                        zstd.kill()
+                        try:
+                            zstd.stdin.close()
+                        except OSError:
+                            pass
+                        raise
+                    finally:
+                        zstd.wait()
+                    if zstd.returncode != 0:
+                        raise OSError(f"zstd failed compressing {info.path}")
+                else:
+                    nar.dump(Path(info.path), out.write)
+            tmp.rename(dest)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+
+    def compression_task(self, info: PathInfo) -> asyncio.Task:
+        """Compression of the NAR of info, started unless it's running."""
+        name = self.nar_name(info)
+        dest = self.narDir / name
+        if name not in self.compressing:
+
+            async def run():
+                async with self.compressJobs:
+                    self.narDir.mkdir(parents=True, exist_ok=True)
+                    await asyncio.to_thread(self.compress, info, dest)
+                    logger.debug(f"Compressed {info.path} into {dest}")
+                    await asyncio.to_thread(self.prune)
+
+            task = asyncio.create_task(run())
+            self.compressing[name] = task
+            task.add_done_callback(lambda _: self.compressing.pop(name, None))
+        return self.compressing[name]
+
+    async def nar_file(self, info: PathInfo) -> Path:
+        """Compressed NAR of info, compressing it unless that's done already."""
+        dest = self.narDir / self.nar_name(info)
+        if not dest.exists():
+            await asyncio.shield(self.compression_task(info))
+        return dest
+
+    async def prepare(self, info: PathInfo):
+        try:
+            await self.nar_file(info)
+        except (OSError, ValueError) as ex:
+            logger.warning(f"Compressing {info.path} failed {ex}")
+
+    def prune(self):
+        """Remove least recently served NARs until we're within maxBytes."""
+        files = []
+        for path in self.narDir.iterdir():
+            # Left behind by an earlier process, ours are being written
+            if path.name.endswith(".tmp"):
+                if not path.name.endswith(f".{os.getpid()}.tmp"):
+                    path.unlink(missing_ok=True)
+            elif path.is_file():
+                files.append((path, path.stat()))
+        total = sum(st.st_size for _, st in files)
+        for path, st in sorted(files, key=lambda f: f[1].st_mtime):
+            if total <= self.maxBytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= st.st_size
+
+    async def send(
+        self,
+        writer: asyncio.StreamWriter,
+        status: int,
+        body: bytes = b"",
+        headers: dict[str, str] = {},
+        head: bool = False,
+    ):
+        headers = {"Content-Length": str(len(body)), **headers}
+        lines = [f"HTTP/1.1 {status} {REASONS[status]}"]
+        lines += [f"{k}: {v}" for k, v in headers.items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode())
+        if not head:
+            writer.write(body)
+        await writer.drain()
+
+    async def send_file(
+        self,
+        writer: asyncio.StreamWriter,
+        path: Path,
+        rangeHeader: str | None,
+        head: bool,
+    ):
+        size = path.stat().st_size
+        status, start, end = 200, 0, size - 1
+        headers = {"Accept-Ranges": "bytes", "Content-Type": "application/x-nix-nar"}
+        if rangeHeader is not None:
+            byteRange = parse_range(rangeHeader, size)
+            if byteRange is None:
+                await self.send(
+                    writer, 416, headers={"Content-Range": f"bytes */{size}"}
+                )
+                return
+            status, (start, end) = 206, byteRange
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+        lines = [f"HTTP/1.1 {status} {REASONS[status]}"]
+        lines += [f"{k}: {v}" for k, v in headers.items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode())
+        await writer.drain()
+        if head:
+            return
+        # Served recently, prune others first
+        os.utime(path)
+        with open(path, "rb") as f:
+            await asyncio.get_running_loop().sendfile(
+                writer.transport, f, start, end - start + 1
+            )
+
+    async def stream_nar(self, writer: asyncio.StreamWriter, info: PathInfo) -> bool:
+        """Send the NAR of info chunked while it's being compressed.
+
+        Returns False without sending anything if it's compressed already,
+        raises if compressing fails before the first byte. Failing later
+        aborts the connection, the client sees a truncated response.
+        """
+        dest = self.narDir / self.nar_name(info)
+        if dest.exists():
+            return False
+        task = self.compression_task(info)
+        f = None
+        started = False
+        try:
+            while True:
+                done = task.done()
+                if f is None:
+                    try:
+                        f = open(self.tmp_path(dest), "rb")
+                    except FileNotFoundError:
+                        # Not started yet, or renamed to dest already
+                        if done:
+                            break
+                        await asyncio.wait([task], timeout=STREAM_POLL)
+                        continue
+                chunk = await asyncio.to_thread(f.read, STREAM_CHUNK)
+                if chunk:
+                    if not started:
+                        writer.write(
+                            b"HTTP/1.1 200 OK\r\n"
+                            b"Content-Type: application/x-nix-nar\r\n"
+                            b"Transfer-Encoding: chunked\r\n\r\n"
+                        )
+                        started = True
+                    writer.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+                    await writer.drain()
+                elif done:
+                    break
+                else:
+                    await asyncio.wait([task], timeout=STREAM_POLL)
+        finally:
+            if f is not None:
+                f.close()
+        if not started:
+            # Failed early, or done before we read anything
+            task.result()
+            return False
+        if task.cancelled() or task.exception() is not None:
+            writer.transport.abort()
+        else:
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        return True
+
+    async def respond(
+        self,
+        writer: asyncio.StreamWriter,
+        method: str,
+        target: str,
+        headers: dict[str, str],
+        version: str = "HTTP/1.1",
+    ):
+        if method not in ["GET", "HEAD"]:
+            await self.send(writer, 405)
+            return
+        head = method == "HEAD"
+        target = target.split("?", 1)[0]
+        if target == "/nix-cache-info":
+            await self.send(
+                writer, 200, CACHE_INFO, {"Content-Type": "text/x-nix-cache-info"}, head
+            )
+        elif target.endswith(".narinfo") and target.count("/") == 1:
+            info = await self.path_info(target[1:].removesuffix(".narinfo"))
+            if info is None:
+                await self.send(writer, 404, head=head)
+                return
+            await self.send(
+                writer,
+                200,
+                self.narinfo(info),
+                {"Content-Type": "text/x-nix-narinfo"},
+                head,
+            )
+            # Nix asks for the NAR next, have it ready
+            if not (self.narDir / self.nar_name(info)).exists():
+                asyncio.create_task(self.prepare(info))
+        elif target.startswith("/nar/") and target.count("/") == 2:
+            name = target.removeprefix("/nar/")
+            info = await self.path_info(name[:32])
+            if info is None or self.nar_name(info) != name:
+                await self.send(writer, 404, head=head)
+                return
+            # Resumed downloads and HTTP/1.0 clients wait for the whole file
+            stream = not head and "range" not in headers and version == "HTTP/1.1"
+            try:
+                if stream and await self.stream_nar(writer, info):
+                    return
+                path = await self.nar_file(info)
+            except ConnectionError:
+                raise
+            except (OSError, ValueError) as ex:
+                logger.warning(f"Compressing {info.path} failed {ex}")
+                await self.send(writer, 500, head=head)
+                return
+            await self.send_file(writer, path, headers.get("range"), head)
+        else:
+            await self.send(writer, 404, head=head)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serve requests on one connection until the client is done."""
+        try:
+            while True:
+                requestLine = await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT)
+                if requestLine == b"":
+                    break
+                parts = requestLine.decode().split()
+                headers: dict[str, str] = {}
+                while True:
+                    line = await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT)
+                    if line in [b"\r\n", b"\n", b""]:
+                        break
+                    name, _, value = line.decode().partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                if len(parts) != 3:
+                    await self.send(writer, 400)
+                    break
+                method, target, version = parts
+                await self.respond(writer, method, target, headers, version)
+                connection = headers.get("connection", "").lower()
+                if version != "HTTP/1.1" or connection == "close":
+                    break
+        except (asyncio.TimeoutError, ConnectionError, UnicodeDecodeError):
+            pass
+        except Exception as ex:
+            logger.warning(f"Binary cache request failed {ex}")
+        finally:
+            writer.close()
+
+    async def serve(self, port: int = HTTP_PORT, host: str | None = None):
+        server = await asyncio.start_server(self.handle, host=host, port=port)
+        logger.info(f"Binary cache listening on port {port} ({self.compression})")
+        return server
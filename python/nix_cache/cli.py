@@ -1,148 +1,278 @@
 #! /usr/bin/env python3
 
 import asyncio
+import json
 import os
+import time
 import kr8s
 import argparse
 import logging
-import textwrap
 from pathlib import Path
-from nix_csi.subprocessing import run_captured
+from .binarycache import BinaryCache
+from .pull import Puller
+
+ARCH_MAP = {
+    "amd64": "x86_64-linux",
+    "arm64": "aarch64-linux",
+}
+
+MACHINES_PATH = Path("/etc/machines")
+
+# Wait this long after the last event before rendering machines
+DEBOUNCE_DELAY = 5
+# Never postpone rendering more than this long during sustained churn
+MAX_DEBOUNCE_WAIT = 60
+
+
+class BuilderState:
+    """In-memory cache of builder nodes and nix-csi-node pods fed by watches."""
+
+    def __init__(self):
+        # node name -> kubernetes.io/arch label (None if missing)
+        self.nodes: dict[str, str | None] = {}
+        # pod name -> (node name, pod IP)
+        self.pods: dict[str, tuple[str | None, str | None]] = {}
+
+    @staticmethod
+    def node_entry(node) -> str | None:
+        return node.metadata.get("labels", {}).get("kubernetes.io/arch")
+
+    @staticmethod
+    def pod_entry(pod) -> tuple[str | None, str | None]:
+        return (pod.spec.get("nodeName"), pod.status.get("podIP"))
+
+    def apply(self, cache: dict, entry, event_type: str, obj) -> bool:
+        """Apply a watch event to cache, returns True if the cache changed."""
+        name = obj.name
+        if event_type == "DELETED":
+            if name not in cache:
+                return False
+            del cache[name]
+            return True
+        if event_type not in ["ADDED", "MODIFIED"]:
+            return False
+        value = entry(obj)
+        if name in cache and cache[name] == value:
+            return False
+        cache[name] = value
+        return True
+
+    def apply_node(self, event_type: str, node) -> bool:
+        return self.apply(self.nodes, self.node_entry, event_type, node)
+
+    def apply_pod(self, event_type: str, pod) -> bool:
+        return self.apply(self.pods, self.pod_entry, event_type, pod)
+
+    def render(self) -> str:
+        """Render the nix machines file from cached state."""
+        builders = []
+        for pod_name, (node_name, pod_ip) in sorted(self.pods.items()):
+            if node_name not in self.nodes or pod_ip is None:
+                continue
+
+            k8s_arch = self.nodes[node_name]
+            if not k8s_arch:
+                logging.warning(
+                    f"Node '{node_name}' missing 'kubernetes.io/arch' label. Skipping pod '{pod_name}'."
+                )
+                continue
 
+            nix_arch = ARCH_MAP.get(k8s_arch)
+            if not nix_arch:
+                logging.warning(
+                    f"Unhandled architecture '{k8s_arch}' for node '{node_name}'. Skipping pod '{pod_name}'."
+                )
+                continue
 
-async def update_machines(namespace: str):
-    """Fetches builder pod info and atomically updates the nix machines file."""
-    try:
-        builder_nodes = {
-            node.name: node
-            async for node in kr8s.asyncio.get(
-                "nodes", label_selector="nix.csi/builder"
+            # Cluster internal DNS search-domain will sort out the full name
+            builders.append(
+                f"ssh-ng://{pod_name}.{os.environ['BUILDERS_SERVICE_NAME']}?trusted=1 {nix_arch}"
             )
-        }
-
-        if not builder_nodes:
-            logging.info("No builder nodes found, preparing to clear machines file.")
-
-        arch_map = {
-            "amd64": "x86_64-linux",
-            "arm64": "aarch64-linux",
-        }
-
-        builders = []
-        async for pod in kr8s.asyncio.get(
-            "pods", namespace=namespace, label_selector={"app": "nix-csi-node"}
-        ):
-            node_name = pod.spec.nodeName
-            if node := builder_nodes.get(node_name):
-                k8s_arch = node.metadata.labels.get("kubernetes.io/arch")
-                if not k8s_arch:
-                    logging.warning(
-                        f"Node '{node_name}' missing 'kubernetes.io/arch' label. Skipping pod '{pod.name}'."
-                    )
-                    continue
 
-                nix_arch = arch_map.get(k8s_arch)
-                if not nix_arch:
-                    logging.warning(
-                        f"Unhandled architecture '{k8s_arch}' for node '{node_name}'. Skipping pod '{pod.name}'."
-                    )
-                    continue
-
-                # Cluster internal DNS search-domain will sort out the full name
-                builders.append(
-                    f"ssh-ng://{pod.metadata['name']}.{os.environ['BUILDERS_SERVICE_NAME']}?trusted=1 {nix_arch}"
-                )
+        return "".join(f"{builder}\n" for builder in builders)
 
-        machines_path = Path("/etc/machines")
-        temp_path = machines_path.with_suffix(".tmp")
-        content = "".join(f"{builder}\n" for builder in builders)
-        temp_path.write_text(content)
-        temp_path.rename(machines_path)
 
-        logging.info(
-            f"Atomically updated {machines_path} with {len(builders)} builders."
-        )
+def write_machines(content: str) -> bool:
+    """Atomically writes the machines file, returns False if it was unchanged."""
+    try:
+        if MACHINES_PATH.read_text() == content:
+            return False
+    except FileNotFoundError:
+        pass
 
-    except kr8s.NotFoundError:
-        logging.warning("Resources not found, skipping update.")
-    except Exception:
-        logging.exception("An error occurred during update.")
+    temp_path = MACHINES_PATH.with_suffix(".tmp")
+    temp_path.write_text(content)
+    temp_path.rename(MACHINES_PATH)
+    return True
 
 
-async def update_worker(update_event: asyncio.Event, namespace: str):
-    """Waits for an update signal, debounces, and runs the update."""
+async def update_worker(update_event: asyncio.Event, state: BuilderState):
+    """Waits for an update signal, debounces with a max wait, and renders."""
     while True:
         await update_event.wait()
-        update_event.clear()
-        logging.info("Change detected. Debouncing for 5 second before update.")
-        await asyncio.sleep(5)
-        await update_machines(namespace)
-
+        first_event_time = time.monotonic()
+        # Wait until events have been quiet for DEBOUNCE_DELAY, but never
+        # longer than MAX_DEBOUNCE_WAIT since the first event.
+        while True:
+            update_event.clear()
+            remaining = MAX_DEBOUNCE_WAIT - (time.monotonic() - first_event_time)
+            if remaining <= 0:
+                logging.info(
+                    f"Max debounce time of {MAX_DEBOUNCE_WAIT}s reached. Forcing update."
+                )
+                break
+            try:
+                await asyncio.wait_for(
+                    update_event.wait(), timeout=min(DEBOUNCE_DELAY, remaining)
+                )
+            except asyncio.TimeoutError:
+                break
 
-async def watch_pods(update_event: asyncio.Event, namespace: str):
-    """Watches for pod events and signals for a config update."""
-    label_selector = {"app": "nix-csi-node"}
-    logging.info(
-        f"Watching for pod events in namespace '{namespace}' with selector '{label_selector}'..."
-    )
-    while True:
         try:
-            async for event_type, obj in kr8s.asyncio.watch(
-                "pods", namespace=namespace, label_selector=label_selector
-            ):
-                if event_type not in ["ADDED", "DELETED"]:
-                    continue
-
+            content = state.render()
+            if write_machines(content):
                 logging.info(
-                    f"Pod event '{event_type}' for {obj.name}. Triggering update."
+                    f"Atomically updated {MACHINES_PATH} with {len(content.splitlines())} builders."
                 )
-                update_event.set()
-
-        except asyncio.CancelledError:
-            logging.info("Pod watcher task cancelled.")
-            break
+            else:
+                logging.debug(f"{MACHINES_PATH} unchanged, skipping write.")
         except Exception:
-            logging.exception("Pod watch error. Retrying in 15 seconds...")
-            await asyncio.sleep(15)
+            logging.exception("An error occurred during update.")
+
 
+async def list_objects(kind: str, **selectors) -> tuple[list, str | None]:
+    """Every object of kind, and the List's resourceVersion to watch from.
 
-async def watch_nodes(update_event: asyncio.Event):
-    """Watches for node label events and signals for a config update."""
-    label_selector = "nix.csi/builder"
-    logging.info(f"Watching for node events with selector '{label_selector}'...")
+    resourceVersions are opaque, only the List's own marks the point the
+    listed objects are consistent at, even when there are none.
+    """
+    api = await kr8s.asyncio.api()
+    objs = []
+    params: dict[str, str | int] = {"limit": 100}
+    while True:
+        async with api.async_get_kind(kind, params=params, **selectors) as (
+            cls,
+            response,
+        ):
+            body = response.json()
+        objs += [cls(item, api=api) for item in body.get("items", [])]
+        metadata = body.get("metadata", {})
+        if metadata.get("continue"):
+            params["continue"] = metadata["continue"]
+        else:
+            return objs, metadata.get("resourceVersion")
+
+
+class Expired(Exception):
+    """The resourceVersion a watch started from is too old, relist."""
+
+
+async def watch_objects(kind: str, resource_version: str | None, **selectors):
+    """Watch events for kind from resource_version as (type, object, version).
+
+    Bookmarks only advance the version, their object is None. kr8s' own
+    watch restarts from the same expired version on 410 Gone, forever.
+    """
+    api = await kr8s.asyncio.api()
+    params = {"resourceVersion": resource_version, "allowWatchBookmarks": "true"}
+    async with api.async_get_kind(
+        kind, params=params, watch=True, timeout=None, **selectors
+    ) as (cls, response):
+        async for line in response.aiter_lines():
+            if not line:
+                continue
+            event = json.loads(line)
+            event_type, raw = event["type"], event["object"]
+            if event_type == "ERROR":
+                if raw.get("code") == 410:
+                    raise Expired(raw.get("message"))
+                raise RuntimeError(f"{kind} watch failed {raw}")
+            version = raw["metadata"]["resourceVersion"]
+            if event_type == "BOOKMARK":
+                yield event_type, None, version
+            else:
+                yield event_type, cls(raw, api=api), version
+
+
+async def informer(
+    kind: str,
+    cache: dict,
+    apply,
+    update_event: asyncio.Event,
+    **selectors,
+):
+    """List once, then keep cache in sync from watch events.
+
+    A normally ended watch resumes from the last seen resourceVersion, errors
+    and expired versions relist from scratch so deletions missed while
+    disconnected are dropped.
+    """
+    logging.info(f"Watching for {kind} events with selectors {selectors}...")
+    resource_version: str | None = None
     while True:
         try:
-            async for event_type, obj in kr8s.asyncio.watch(
-                "nodes", label_selector=label_selector
-            ):
-                if event_type not in ["ADDED", "DELETED"]:
-                    continue
-                logging.info(
-                    f"Node event '{event_type}' for {obj.name}. Triggering update."
-                )
+            if resource_version is None:
+                objs, resource_version = await list_objects(kind, **selectors)
+                cache.clear()
+                for obj in objs:
+                    apply("ADDED", obj)
+                logging.info(f"Listed {len(objs)} {kind}.")
                 update_event.set()
 
+            async for event_type, obj, resource_version in watch_objects(
+                kind, resource_version, **selectors
+            ):
+                if obj is not None and apply(event_type, obj):
+                    logging.info(
+                        f"{kind} event '{event_type}' for {obj.name}. Triggering update."
+                    )
+                    update_event.set()
+
         except asyncio.CancelledError:
-            logging.info("Node watcher task cancelled.")
+            logging.info(f"{kind} watcher task cancelled.")
             break
+        except Expired as ex:
+            logging.info(f"{kind} watch expired, relisting: {ex}")
+            resource_version = None
         except Exception:
-            logging.exception("Node watch error. Retrying in 15 seconds...")
+            logging.exception(f"{kind} watch error. Relisting in 15 seconds...")
+            resource_version = None
             await asyncio.sleep(15)
 
 
 async def async_main():
     namespace = os.environ["KUBE_NAMESPACE"]
 
+    state = BuilderState()
     # This event will be used to signal when an update is needed.
     update_needed_event = asyncio.Event()
-
-    # Trigger an initial update on startup
-    update_needed_event.set()
+    # Only nix-csi-node pods may ask us to pull from them
+    puller = Puller(state.pods)
+    binaryCache = await BinaryCache().serve()
 
     tasks = [
-        asyncio.create_task(update_worker(update_needed_event, namespace)),
-        asyncio.create_task(watch_pods(update_needed_event, namespace)),
-        asyncio.create_task(watch_nodes(update_needed_event)),
+        asyncio.create_task(binaryCache.serve_forever()),
+        asyncio.create_task(update_worker(update_needed_event, state)),
+        asyncio.create_task(puller.serve()),
+        asyncio.create_task(
+            informer(
+                "pods",
+                state.pods,
+                state.apply_pod,
+                update_needed_event,
+                namespace=namespace,
+                label_selector={"app": "nix-csi-node"},
+            )
+        ),
+        asyncio.create_task(
+            informer(
+                "nodes",
+                state.nodes,
+                state.apply_node,
+                update_needed_event,
+                label_selector="nix.csi/builder",
+            )
+        ),
     ]
 
     await asyncio.gather(*tasks)
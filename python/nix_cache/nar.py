@@ -0,0 +1,55 @@
+import hashlib
+import os
+import stat
+import struct
+from pathlib import Path
+from typing import Callable
+
+# Nix ARchive serialization of store paths, the format binary caches serve.
+# Directory entries are sorted by name, only the executable bit of regular
+# files is kept.
+
+CHUNK = 1024 * 1024
+
+
+def _str(data: bytes) -> bytes:
+    return struct.pack("<Q", len(data)) + data + b"\0" * (-len(data) % 8)
+
+
+def dump(path: Path, write: Callable[[bytes], object]):
+    """Write the NAR serialization of path through write."""
+    write(_str(b"nix-archive-1"))
+    _node(path, write)
+
+
+def _node(path: Path, write: Callable[[bytes], object]):
+    st = os.lstat(path)
+    write(_str(b"(") + _str(b"type"))
+    if stat.S_ISLNK(st.st_mode):
+        write(_str(b"symlink") + _str(b"target") + _str(os.fsencode(os.readlink(path))))
+    elif stat.S_ISDIR(st.st_mode):
+        write(_str(b"directory"))
+        for name in sorted(os.listdir(path), key=os.fsencode):
+            write(_str(b"entry") + _str(b"(") + _str(b"name") + _str(os.fsencode(name)))
+            write(_str(b"node"))
+            _node(path / name, write)
+            write(_str(b")"))
+    elif stat.S_ISREG(st.st_mode):
+        write(_str(b"regular"))
+        if st.st_mode & stat.S_IXUSR:
+            write(_str(b"executable") + _str(b""))
+        write(_str(b"contents") + struct.pack("<Q", st.st_size))
+        with open(path, "rb") as f:
+            while chunk := f.read(CHUNK):
+                write(chunk)
+        write(b"\0" * (-st.st_size % 8))
+    else:
+        raise ValueError(f"{path} can't be serialized to a NAR")
+    write(_str(b")"))
+
+
+def nar_hash(path: Path) -> str:
+    """Hex SHA-256 of the NAR serialization of path."""
+    digest = hashlib.sha256()
+    dump(path, digest.update)
+    return digest.hexdigest()
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import os
+from pathlib import Path
+
+from nix_csi import daemon
+from nix_csi.subprocessing import run_captured
+
+# Nodes ask the cache to pull their freshly built paths instead of pushing
+# them: a node sends `POST /pull` with one store path per line, the cache
+# copies what it's missing from the node over a multiplexed SSH connection
+# and signs it, so nodes substitute from the cache without trusting it.
+
+logger = logging.getLogger("nix-csi")
+
+PULL_PORT = int(os.environ.get("PULL_PORT", "8181"))
+# Paths are signed with this key as they land, unsigned if it's missing
+SECRET_KEY_PATH = Path(
+    os.environ.get("NIX_CACHE_SECRET_KEY", "/etc/nix-cache/secret-key")
+)
+# Pulls running at once, each from a different node
+PULL_WORKERS = int(os.environ.get("PULL_WORKERS", "2"))
+# Largest pull request we read
+MAX_REQUEST = 1024 * 1024
+REQUEST_TIMEOUT = 5.0
+
+# One SSH connection per node, reused by every pull for a while
+SSH_OPTS = (
+    "-o ControlMaster=auto "
+    "-o ControlPath=/run/nix-cache-ssh-%C "
+    "-o ControlPersist=120"
+)
+
+
+class Puller:
+    """Queue of paths to pull, coalesced per node."""
+
+    def __init__(self, allowed: dict[str, tuple[str | None, str | None]]):
+        # pod name -> (node name, pod IP) of nix-csi-node pods, from the informer
+        self.allowed = allowed
+        # node IP -> paths waiting to be pulled
+        self.pending: dict[str, set[str]] = {}
+        self.ready: asyncio.Queue[str] = asyncio.Queue()
+
+    def allowed_ip(self, ip: str) -> bool:
+        return any(podIP == ip for _, podIP in self.allowed.values())
+
+    def enqueue(self, ip: str, paths: list[str]):
+        if ip not in self.pending:
+            self.pending[ip] = set()
+            self.ready.put_nowait(ip)
+        self.pending[ip].update(paths)
+
+    async def pull(self, ip: str, paths: set[str]):
+        valid = await asyncio.gather(*[daemon.is_valid_path(p) for p in paths])
+        missing = sorted(p for p, v in zip(paths, valid) if not v)
+        if len(missing) == 0:
+            return
+        # Nodes don't sign, what we pull is signed by us below
+        result = await run_captured(
+            "nix",
+            "copy",
+            "--no-check-sigs",
+            "--from",
+            f"ssh-ng://nix@{ip}",
+            *missing,
+        )
+        if result.returncode != 0:
+            logger.warning(f"Pulling {len(missing)} paths from {ip} failed")
+            logger.debug(result.combined)
+            return
+        logger.info(f"Pulled {len(missing)} paths from {ip}")
+        if SECRET_KEY_PATH.exists():
+            sign = await run_captured(
+                "nix",
+                "store",
+                "sign",
+                "--key-file",
+                SECRET_KEY_PATH,
+                "--recursive",
+                *missing,
+            )
+            if sign.returncode != 0:
+                logger.warning(f"Signing paths from {ip} failed {sign.combined}")
+
+    async def worker(self):
+        while True:
+            ip = await self.ready.get()
+            # Requests arriving while we pull wait for the next round
+            paths = self.pending.pop(ip)
+            try:
+                await self.pull(ip, paths)
+            except Exception as ex:
+                logger.warning(f"Pulling from {ip} failed {ex}")
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Answers `POST /pull` with 202 once the paths are queued."""
+        ip = writer.get_extra_info("peername")[0]
+        try:
+            requestLine = await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)
+            length = 0
+            while True:
+                header = await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)
+                if header in [b"\r\n", b"\n", b""]:
+                    break
+                name, _, value = header.decode().partition(":")
+                if name.strip().lower() == "content-length":
+                    length = int(value)
+            if requestLine.split()[:2] != [b"POST", b"/pull"]:
+                status = "404 Not Found"
+            elif not self.allowed_ip(ip):
+                status = "403 Forbidden"
+            elif length <= 0 or length > MAX_REQUEST:
+                status = "400 Bad Request"
+            else:
+                body = await asyncio.wait_for(
+                    reader.readexactly(length), REQUEST_TIMEOUT
+                )
+                paths = [p for p in body.decode().splitlines() if p != ""]
+                if any(not p.startswith("/nix/store/") or ".." in p for p in paths):
+                    status = "400 Bad Request"
+                else:
+                    self.enqueue(ip, paths)
+                    status = "202 Accepted"
+            writer.write(f"HTTP/1.0 {status}\r\nContent-Length: 0\r\n\r\n".encode())
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError, OSError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, port: int = PULL_PORT):
+        os.environ.setdefault("NIX_SSHOPTS", SSH_OPTS)
+        if not SECRET_KEY_PATH.exists():
+            logger.warning(f"{SECRET_KEY_PATH} missing, pulled paths stay unsigned")
+        server = await asyncio.start_server(self.handle, port=port)
+        logger.info(f"Pull requests accepted on port {port}")
+        await asyncio.gather(
+            server.serve_forever(), *[self.worker() for _ in range(PULL_WORKERS)]
+        )
@@ -1 +1,8 @@
-from .identityservicer import IdentityServicer
+def __getattr__(name: str):
+    # Importing the gRPC servicers loads grpclib and protobuf, only do that
+    # for whoever asks for them rather than for every nix_csi module
+    if name == "IdentityServicer":
+        from .identityservicer import IdentityServicer
+
+        return IdentityServicer
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
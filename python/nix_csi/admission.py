@@ -0,0 +1,85 @@
+import asyncio
+import logging
+import os
+from collections import deque
+from contextlib import asynccontextmanager
+
+from grpclib import GRPCError
+from grpclib.const import Status
+
+logger = logging.getLogger("nix-csi")
+
+
+class Admission:
+    """Bounds concurrent work of one kind, with a bounded queue of waiters.
+
+    Work that doesn't fit in the queue is rejected with RESOURCE_EXHAUSTED so
+    kubelet backs off and retries instead of piling up processes. Priority
+    work (retries of volumes we already started on) skips the queue limit
+    and is admitted before everything else. Each queue is first come first
+    served.
+    """
+
+    def __init__(self, name: str, limit: int, queue: int, retryAfter: int = 10):
+        self.name = name
+        self.limit = limit
+        self.queue = queue
+        self.retryAfter = retryAfter
+        self.running = 0
+        self.waiters: deque[asyncio.Future] = deque()
+        self.priorityWaiters: deque[asyncio.Future] = deque()
+
+    @classmethod
+    def from_env(cls, name: str, limit: int, queue: int = 32):
+        """Admission configured by NIX_CSI_MAX_<NAME> and NIX_CSI_QUEUE_<NAME>."""
+        return cls(
+            name,
+            int(os.environ.get(f"NIX_CSI_MAX_{name.upper()}", limit)),
+            int(os.environ.get(f"NIX_CSI_QUEUE_{name.upper()}", queue)),
+        )
+
+    @asynccontextmanager
+    async def slot(self, priority: bool = False):
+        queued = len(self.waiters) + len(self.priorityWaiters)
+        if self.running < self.limit and queued == 0:
+            self.running += 1
+        else:
+            if len(self.waiters) >= self.queue and not priority:
+                logger.info(f"Rejecting {self.name}, {len(self.waiters)} queued")
+                raise GRPCError(
+                    Status.RESOURCE_EXHAUSTED,
+                    f"Too many concurrent {self.name}, retry in {self.retryAfter}s",
+                )
+            waiter = asyncio.get_running_loop().create_future()
+            waiters = self.priorityWaiters if priority else self.waiters
+            waiters.append(waiter)
+            try:
+                # The releasing task hands its slot over to us
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    self.release()
+                elif waiter in waiters:
+                    waiters.remove(waiter)
+                raise
+        try:
+            yield
+        finally:
+            self.release()
+
+    def release(self):
+        for waiters in [self.priorityWaiters, self.waiters]:
+            while len(waiters) > 0:
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+                    return
+        self.running -= 1
+
+
+# nix build of store paths, substitution and building
+builds = Admission.from_env("builds", 4)
+# nix build of flakeRef and nixExpr, evaluation is what eats memory
+evaluations = Admission.from_env("evaluations", 2)
+# Materializing closures into volumes, hardlink farms and images
+copies = Admission.from_env("copies", 1)
@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import os
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from .kubernetes import get_builder_ips
+from .subprocessing import run_captured
+
+logger = logging.getLogger("nix-csi")
+
+# How long a builder list fetched from the API server is reused
+BUILDERS_TTL = 30.0
+# How long we wait for a builder to report its load before skipping it
+LOAD_TIMEOUT = 5.0
+# How long a builder's load is reused, publishes in between don't ssh to it
+LOAD_TTL = 10.0
+
+# system -> (fetch time, builder IPs)
+builderCache: dict[str, tuple[float, list[str]]] = {}
+# builder IP -> (query time, load query), concurrent publishes share a query
+loadCache: dict[str, tuple[float, asyncio.Task]] = {}
+# Builds this daemon currently has running on each builder
+inflight: Counter[str] = Counter()
+
+
+async def get_builders(system: str) -> list[str]:
+    """Builder pod IPs able to build system, excluding ourselves."""
+    namespace = os.environ.get("KUBE_NAMESPACE")
+    if namespace is None:
+        return []
+
+    fetched, builders = builderCache.get(system, (0.0, []))
+    if time.monotonic() - fetched > BUILDERS_TTL:
+        try:
+            builders = await get_builder_ips(namespace, system)
+        except Exception as ex:
+            logger.warning(f"Failed to list builders {ex}")
+            builders = []
+        builderCache[system] = (time.monotonic(), builders)
+        # Forget loads of builders that are gone
+        current = {ip for _, ips in builderCache.values() for ip in ips}
+        for ip in [ip for ip in loadCache if ip not in current]:
+            del loadCache[ip]
+
+    podIP = os.environ.get("KUBE_POD_IP")
+    return [ip for ip in builders if ip != podIP]
+
+
+async def query_load(ip: str) -> tuple[float, int] | None:
+    """1 minute load average and CPUs of builder, None if it's unreachable."""
+    try:
+        result = await asyncio.wait_for(
+            run_captured("ssh", f"nix@{ip}", "--", "cat /proc/loadavg && nproc"),
+            timeout=LOAD_TIMEOUT,
+        )
+        if result.returncode != 0:
+            logger.debug(f"Builder {ip} load query failed {result.combined}")
+            return None
+        loadavg, nproc = result.stdout.splitlines()[:2]
+        return float(loadavg.split()[0]), max(int(nproc), 1)
+    except (asyncio.TimeoutError, OSError, ValueError) as ex:
+        logger.debug(f"Builder {ip} load query failed {ex}")
+        return None
+
+
+async def builder_load(ip: str) -> tuple[float, int] | None:
+    """query_load of builder, reused for LOAD_TTL."""
+    fetched, query = loadCache.get(ip, (0.0, None))
+    if query is None or time.monotonic() - fetched > LOAD_TTL:
+        query = asyncio.create_task(query_load(ip))
+        loadCache[ip] = (time.monotonic(), query)
+    return await asyncio.shield(query)
+
+
+async def pick_builder(system: str) -> str | None:
+    """Least loaded reachable builder, counting builds we've already sent it."""
+    builders = await get_builders(system)
+    if len(builders) == 0:
+        return None
+
+    loads = await asyncio.gather(*[builder_load(ip) for ip in builders])
+    # Builds we sent are runnable processes the load average may not show
+    # yet, both are spread over the builder's CPUs
+    candidates = [
+        ((load[0] + inflight[ip]) / load[1], ip)
+        for ip, load in zip(builders, loads)
+        if load is not None
+    ]
+    if len(candidates) == 0:
+        return None
+    return min(candidates)[1]
+
+
+@asynccontextmanager
+async def remote_build_args(system: str):
+    """Yields `nix build` arguments offloading builds to the least loaded builder.
+
+    Evaluation and substitution still happen locally, only derivations that
+    have to be built are sent to the builder. Yields an empty list when there
+    are no usable builders.
+    """
+    ip = await pick_builder(system)
+    if ip is None:
+        yield []
+        return
+
+    logger.debug(f"Offloading build to {ip}")
+    inflight[ip] += 1
+    try:
+        yield [
+            "--builders",
+            f"ssh-ng://nix@{ip}?trusted=1 {system}",
+            "--max-jobs",
+            "0",
+        ]
+    finally:
+        inflight[ip] -= 1
+        if inflight[ip] <= 0:
+            del inflight[ip]
@@ -1,7 +1,6 @@
 import asyncio
 import logging
 import argparse
-from . import service
 
 
 def parse_args():
@@ -27,6 +26,9 @@ async def async_main():
 
     logging.getLogger("nix-csi").setLevel(getattr(logging, args.loglevel))
 
+    # After parsing arguments so --help doesn't load the whole driver
+    from . import service
+
     await service.serve()
 
 
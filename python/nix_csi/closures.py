@@ -0,0 +1,193 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+from collections import Counter, OrderedDict
+from pathlib import Path
+from . import daemon
+from .daemon import PathInfo
+
+logger = logging.getLogger("nix-csi")
+
+# Path infos never change while a path is valid, and the GC never deletes a
+# path that something valid references. So a cached closure is correct for
+# as long as its root exists, the only invalidation we need is forgetting
+# paths the GC deleted.
+#
+# Memory holds the closures of the most recently used roots and the path
+# infos in them, everything else is read back from SQLite when needed.
+
+# Closures kept in memory, least recently used are dropped first
+MAX_CLOSURES = int(os.environ.get("CLOSURE_CACHE_SIZE", "256"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS PathInfos (
+    path TEXT PRIMARY KEY,
+    deriver TEXT,
+    narHash TEXT NOT NULL,
+    narSize INTEGER NOT NULL,
+    refs TEXT NOT NULL,
+    registrationTime INTEGER NOT NULL,
+    ultimate INTEGER NOT NULL,
+    sigs TEXT NOT NULL,
+    ca TEXT
+)
+"""
+
+
+class ClosureCache:
+    """Path infos and closures kept in memory, backed by SQLite on disk."""
+
+    def __init__(self, maxClosures: int = MAX_CLOSURES):
+        self.maxClosures = maxClosures
+        # Path infos of every path in a cached closure
+        self.infos: dict[str, PathInfo] = {}
+        # path -> number of cached closures containing it
+        self.users: Counter[str] = Counter()
+        # root -> every path in its closure, least recently used first
+        self.closures: OrderedDict[str, list[str]] = OrderedDict()
+        self.db: sqlite3.Connection | None = None
+
+    def open(self, dbPath: Path):
+        """Persist path infos in dbPath, memory only until this is called."""
+        try:
+            dbPath.parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(dbPath, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(SCHEMA)
+            self.db = db
+        except sqlite3.Error as ex:
+            logger.warning(f"Closure cache {dbPath} unusable, memory only {ex}")
+
+    def load(self, path: str) -> PathInfo | None:
+        if self.db is None:
+            return None
+        row = self.db.execute(
+            "SELECT * FROM PathInfos WHERE path = ?", (path,)
+        ).fetchone()
+        if row is None:
+            return None
+        return PathInfo(
+            row[0],
+            row[1],
+            row[2],
+            json.loads(row[4]),
+            row[5],
+            row[3],
+            bool(row[6]),
+            json.loads(row[7]),
+            row[8],
+        )
+
+    def store(self, infos: list[PathInfo]):
+        if self.db is None or len(infos) == 0:
+            return
+        self.db.executemany(
+            "INSERT OR REPLACE INTO PathInfos VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    i.path,
+                    i.deriver,
+                    i.narHash,
+                    i.narSize,
+                    json.dumps(i.references),
+                    i.registrationTime,
+                    int(i.ultimate),
+                    json.dumps(i.sigs),
+                    i.ca,
+                )
+                for i in infos
+            ],
+        )
+
+    async def path_info(self, path: Path | str) -> PathInfo | None:
+        path = str(path)
+        if path in self.infos and os.path.lexists(path):
+            return self.infos[path]
+
+        info = self.load(path)
+        if info is None or not os.path.lexists(path):
+            info = await daemon.query_path_info(path)
+            if info is None:
+                self.forget([path])
+                return None
+            self.store([info])
+        return info
+
+    async def closure(self, path: Path | str) -> list[PathInfo]:
+        """Path infos of path and everything it references, recursively."""
+        root = str(path)
+        if not os.path.lexists(root):
+            # Deleted (or never there), ask the daemon in case it's back
+            self.forget([root])
+
+        if root in self.closures:
+            self.closures.move_to_end(root)
+        else:
+            found: dict[str, PathInfo] = {}
+            missing = []
+            seen: set[str] = set()
+            frontier = {root}
+            while len(frontier) > 0:
+                for p in frontier:
+                    info = self.infos.get(p) or self.load(p)
+                    if info is not None:
+                        found[p] = info
+                fetch = [p for p in frontier if p not in found]
+                results = await asyncio.gather(
+                    *[daemon.query_path_info(p) for p in fetch]
+                )
+                for info in results:
+                    if info is not None:
+                        found[info.path] = info
+                        missing.append(info)
+                seen.update(frontier)
+                frontier = {
+                    r
+                    for p in frontier
+                    if p in found
+                    for r in found[p].references
+                    if r not in seen
+                }
+            self.store(missing)
+            if root not in found:
+                return []
+            self.add(root, found)
+
+        return [self.infos[p] for p in self.closures[root]]
+
+    def add(self, root: str, infos: dict[str, PathInfo]):
+        """Keep the closure of root in memory, dropping the least recent."""
+        closure = sorted(infos)
+        for p in closure:
+            self.infos[p] = infos[p]
+            self.users[p] += 1
+        self.closures[root] = closure
+        while len(self.closures) > self.maxClosures:
+            _, evicted = self.closures.popitem(last=False)
+            self.release(evicted)
+
+    def release(self, closure: list[str]):
+        """Drop path infos no cached closure contains anymore."""
+        for p in closure:
+            self.users[p] -= 1
+            if self.users[p] <= 0:
+                del self.users[p]
+                self.infos.pop(p, None)
+
+    def forget(self, paths: list[str]):
+        """Drop paths deleted by GC, and every closure containing them."""
+        gone = set(paths)
+        for root, closure in list(self.closures.items()):
+            if root in gone or not gone.isdisjoint(closure):
+                del self.closures[root]
+                self.release(closure)
+        if self.db is not None and len(gone) > 0:
+            self.db.executemany(
+                "DELETE FROM PathInfos WHERE path = ?", [(p,) for p in gone]
+            )
+
+
+cache = ClosureCache()
@@ -0,0 +1,123 @@
+import asyncio
+import logging
+import os
+import stat
+from pathlib import Path
+from .subprocessing import try_captured
+
+logger = logging.getLogger("nix-csi")
+
+# Composefs images describe a /nix tree whose file contents are redirects to
+# the host's store objects (and a per image Nix database), so a closure is
+# packed once, mounted with a single syscall and shares page cache with the
+# host store without creating a dentry per file per volume.
+
+# Backing files are resolved relative to this directory when mounting
+BASEDIR = Path("/")
+
+
+def escape(value: str) -> str:
+    """Escape a composefs-dump(5) field."""
+    if value == "-":
+        return "\\x2d"
+    out = []
+    for c in value:
+        if c == "\\":
+            out.append("\\\\")
+        elif c == "\n":
+            out.append("\\n")
+        elif c == "\r":
+            out.append("\\r")
+        elif c == "\t":
+            out.append("\\t")
+        elif not c.isprintable() or c.isspace() or c == "=":
+            out.append("".join(f"\\x{b:02x}" for b in c.encode()))
+        else:
+            out.append(c)
+    return "".join(out)
+
+
+def entry(path: str, st: os.stat_result, nlink: int, payload: str | None) -> str:
+    mtime = f"{st.st_mtime_ns // 1_000_000_000}.{st.st_mtime_ns % 1_000_000_000}"
+    # Symlinks are sized by the length of their target
+    size = st.st_size if not stat.S_ISDIR(st.st_mode) else 0
+    return " ".join(
+        [
+            escape(path),
+            str(size),
+            f"{st.st_mode:o}",
+            str(nlink),
+            str(st.st_uid),
+            str(st.st_gid),
+            "0",
+            mtime,
+            "-" if payload is None else escape(payload),
+            "-",
+            "-",
+        ]
+    )
+
+
+def subdirs(path: Path) -> int:
+    return sum(1 for p in os.scandir(path) if p.is_dir(follow_symlinks=False))
+
+
+def walk(source: Path, dest: str, lines: list[str]):
+    """Describe source at dest in the image, file contents redirect to source."""
+    st = os.lstat(source)
+    if stat.S_ISDIR(st.st_mode):
+        lines.append(entry(dest, st, 2 + subdirs(source), None))
+        for name in sorted(os.listdir(source)):
+            walk(source / name, f"{dest}/{name}", lines)
+    elif stat.S_ISLNK(st.st_mode):
+        lines.append(entry(dest, st, 1, os.readlink(source)))
+    elif stat.S_ISREG(st.st_mode):
+        # Empty files have no backing file
+        payload = str(source.relative_to(BASEDIR)) if st.st_size > 0 else None
+        lines.append(entry(dest, st, 1, payload))
+
+
+def dump(nixRoot: Path, paths: list[str]) -> str:
+    """composefs-dump(5) of nixRoot with the store replaced by paths."""
+    root = os.lstat(nixRoot)
+    store = os.lstat(Path(paths[0]).parent) if paths else root
+    storeDirs = sum(1 for p in paths if os.path.isdir(p) and not os.path.islink(p))
+    lines = [
+        entry("/", root, 2 + 1 + subdirs(nixRoot), None),
+        entry("/store", store, 2 + storeDirs, None),
+    ]
+    for path in sorted(paths):
+        walk(Path(path), f"/store/{Path(path).name}", lines)
+    # Everything else (database, gcroots, result) comes from nixRoot
+    for name in sorted(os.listdir(nixRoot)):
+        walk(nixRoot / name, f"/{name}", lines)
+    return "\n".join(lines) + "\n"
+
+
+async def build_image(sharedRoot: Path, paths: list[str]) -> Path:
+    """Pack the closure at paths and sharedRoot/state into sharedRoot/image.cfs.
+
+    sharedRoot/state holds the /nix tree except the store (see init_state).
+    """
+    nixRoot = sharedRoot / "state"
+    image = sharedRoot / "image.cfs"
+    dumpFile = sharedRoot / "image.dump"
+    # Walking the closure is blocking IO, keep the event loop responsive
+    dumpFile.write_text(await asyncio.to_thread(dump, nixRoot, paths))
+    await try_captured("mkcomposefs", "--from-file", dumpFile, image)
+    dumpFile.unlink()
+    return image
+
+
+async def mount_image(image: Path, target: Path):
+    target.mkdir(parents=True, exist_ok=True)
+    await try_captured(
+        "mount",
+        "--verbose",
+        "-t",
+        "composefs",
+        "-o",
+        f"ro,basedir={BASEDIR}",
+        image,
+        target,
+    )
@@ -1,41 +1,356 @@
+import asyncio
 import logging
-from collections import defaultdict
+import os
+import time
 from pathlib import Path
 from asyncio import Semaphore, sleep
-from .subprocessing import run_captured, run_console
+from . import closures
+from .daemon import DaemonError, PathInfo
+from .locks import KeyedLock
+from .subprocessing import run_captured
 
 logger = logging.getLogger("nix-csi")
 
+# Pull mode: ask nix-cache to pull paths from us and sign them rather than
+# pushing them as a trusted user
+CACHE_PULL = os.environ.get("CACHE_PULL", "false") == "true"
+PULL_PORT = int(os.environ.get("PULL_PORT", "8181"))
+PULL_TIMEOUT = 5.0
+
+# Pulled paths are signed, so they can come over the cache's HTTP binary
+# cache without trusting it
+CACHE_SUBSTITUTER = (
+    "http://nix-cache?priority=20"
+    if CACHE_PULL
+    else "ssh-ng://nix@nix-cache?trusted=1&priority=20"
+)
+
+# Push mode transfers NARs with nix-store --export | zstd | ssh nix-store
+# --import rather than nix copy, so transfers run in parallel and are only
+# compressed when that makes them faster.
+# Transfers to the cache running at once, over all uploads
+COPY_JOBS = int(os.environ.get("COPY_JOBS", "4"))
+ZSTD_LEVEL = 3
+# Every this many transfers the slower of plain and zstd is tried again, in
+# case the link got faster or slower
+REPROBE_EVERY = 16
+# Files like these don't get smaller, paths mostly made of them aren't compressed
+COMPRESSED_SUFFIXES = (
+    ".gz",
+    ".tgz",
+    ".xz",
+    ".bz2",
+    ".zst",
+    ".lz4",
+    ".br",
+    ".zip",
+    ".jar",
+    ".whl",
+    ".png",
+    ".jpg",
+    ".jpeg",
+    ".webp",
+    ".woff2",
+    ".squashfs",
+)
+# One SSH connection to the cache, shared by concurrent transfers
+SSH_OPTS = [
+    "-o",
+    "ControlMaster=auto",
+    "-o",
+    "ControlPath=/tmp/nix-csi-ssh-%C",
+    "-o",
+    "ControlPersist=60",
+]
+PUMP_CHUNK = 1024 * 1024
+# A single transfer taking longer than this is given up and retried
+TRANSFER_TIMEOUT = float(os.environ.get("COPY_TRANSFER_TIMEOUT", 1800))
+REAP_TIMEOUT = 5.0
+
+transferSlots = Semaphore(COPY_JOBS)
+# Moving average of NAR bytes/s pushed to the cache, plain (False) and zstd
+# compressed (True), whichever is faster on this link is used
+narRates: dict[bool, float] = {}
+transfers = 0
+
 # Locks that prevent the same derivation to be uploaded in parallel
-copyLock: defaultdict[Path, Semaphore] = defaultdict(Semaphore)
+copyLock = KeyedLock("copy")
+
+
+async def request_pull(paths: set[str]) -> bool:
+    """Queue paths for nix-cache to pull from us, True if it accepted."""
+    body = "".join(f"{p}\n" for p in sorted(paths)).encode()
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection("nix-cache", PULL_PORT), PULL_TIMEOUT
+        )
+        try:
+            writer.write(
+                f"POST /pull HTTP/1.0\r\nContent-Length: {len(body)}\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+            statusLine = await asyncio.wait_for(reader.readline(), PULL_TIMEOUT)
+            return statusLine.split()[1:2] == [b"202"]
+        finally:
+            writer.close()
+    except (asyncio.TimeoutError, OSError) as ex:
+        logger.debug(f"Pull request to nix-cache failed {ex}")
+        return False
+
+
+def compressible(paths: list[str]) -> bool:
+    """False if most bytes of paths are in already compressed files."""
+    total = 0
+    compressed = 0
+    for path in paths:
+        for root, _, files in os.walk(path):
+            for name in files:
+                try:
+                    size = os.lstat(os.path.join(root, name)).st_size
+                except OSError:
+                    continue
+                total += size
+                if name.lower().endswith(COMPRESSED_SUFFIXES):
+                    compressed += size
+    return compressed * 2 <= total
+
+
+async def invalid_on_cache(paths: list[str]) -> list[str] | None:
+    """Those of paths the cache doesn't have, None if we couldn't ask."""
+    check = await run_captured(
+        "ssh",
+        *SSH_OPTS,
+        "nix@nix-cache",
+        "--",
+        "nix-store",
+        "--check-validity",
+        "--print-invalid",
+        *paths,
+    )
+    if check.returncode != 0:
+        logger.debug(f"Checking paths on cache failed {check.combined}")
+        return None
+    return [p for p in check.stdout.splitlines() if p != ""]
+
+
+def kill(procs: list[asyncio.subprocess.Process]):
+    for proc in procs:
+        if proc.returncode is None:
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+
+
+async def transfer(paths: list[str], narBytes: int, compress: bool) -> bool:
+    """Export paths into the cache's store, measuring throughput."""
+    start = time.perf_counter()
+    procs: list[asyncio.subprocess.Process] = []
+    read, write = os.pipe()
+    try:
+        export = await asyncio.create_subprocess_exec(
+            "nix-store",
+            "--export",
+            *paths,
+            stdout=write if compress else asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        procs.append(export)
+        source = export.stdout
+        if compress:
+            zstd = await asyncio.create_subprocess_exec(
+                "zstd",
+                "--quiet",
+                f"-{ZSTD_LEVEL}",
+                "-T0",
+                "-c",
+                stdin=read,
+                stdout=asyncio.subprocess.PIPE,
+            )
+            procs.append(zstd)
+            source = zstd.stdout
+    except OSError:
+        kill(procs)
+        raise
+    finally:
+        os.close(write)
+        os.close(read)
+
+    async def reap():
+        """Wait for procs, draining what's left so nothing blocks writing."""
+        if source is not None:
+            while await source.read(PUMP_CHUNK):
+                pass
+        await asyncio.gather(*[proc.wait() for proc in procs])
+
+    try:
+        remote = "zstd -d | nix-store --import" if compress else "nix-store --import"
+        ssh = await asyncio.create_subprocess_exec(
+            "ssh",
+            *SSH_OPTS,
+            "nix@nix-cache",
+            "--",
+            remote,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        procs.append(ssh)
+        assert source is not None and ssh.stdin is not None
+        assert ssh.stderr is not None
+        stderr = asyncio.create_task(ssh.stderr.read())
+
+        async def pump() -> int:
+            """Copy into ssh counting what goes on the wire."""
+            wireBytes = 0
+            try:
+                while chunk := await source.read(PUMP_CHUNK):
+                    wireBytes += len(chunk)
+                    ssh.stdin.write(chunk)
+                    await ssh.stdin.drain()
+            except ConnectionError:
+                # ssh is gone, nobody reads what export and zstd still write
+                kill(procs)
+            finally:
+                ssh.stdin.close()
+            await reap()
+            return wireBytes
+
+        wireBytes = await asyncio.wait_for(pump(), TRANSFER_TIMEOUT)
+        codes = [proc.returncode for proc in procs]
+        if any(code != 0 for code in codes):
+            logger.warning(
+                f"Transfer of {len(paths)} paths failed {codes=} "
+                f"{(await stderr).decode()}"
+            )
+            return False
+    except asyncio.TimeoutError:
+        logger.warning(f"Transfer of {len(paths)} paths timed out")
+        return False
+    finally:
+        # Don't leave anything behind holding pipes, also when cancelled
+        kill(procs)
+        try:
+            await asyncio.wait_for(reap(), REAP_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Transfer processes of {len(paths)} paths didn't exit")
+
+    elapsed = max(time.perf_counter() - start, 1e-6)
+    rate = narBytes / elapsed
+    narRates[compress] = 0.8 * narRates.get(compress, rate) + 0.2 * rate
+    logger.info(
+        f"Transferred {len(paths)} paths {narBytes / 1024**2:.1f}MiB "
+        f"({wireBytes / 1024**2:.1f}MiB on the wire{', zstd' if compress else ''}) "
+        f"in {elapsed:.1f}s, {narBytes / elapsed / 1024**2:.1f}MiB/s"
+    )
+    return True
+
+
+def use_zstd() -> bool:
+    """Whether to compress the next compressible transfer."""
+    global transfers
+    transfers += 1
+    # Measure both ways first, compressed while we know nothing
+    for compress in [True, False]:
+        if compress not in narRates:
+            return compress
+    faster = narRates[True] >= narRates[False]
+    return faster if transfers % REPROBE_EVERY != 0 else not faster
+
+
+def levels(missing: list[str], infos: dict[str, PathInfo]) -> list[list[str]]:
+    """Group missing paths so every path comes after the paths it references."""
+    remaining = set(missing)
+    done: set[str] = set()
+    result = []
+    while len(remaining) > 0:
+        level = [
+            p
+            for p in remaining
+            if all(
+                r == p or r in done or r not in remaining for r in infos[p].references
+            )
+        ]
+        if len(level) == 0:
+            # Reference cycles can't happen, but don't spin if they do
+            level = list(remaining)
+        result.append(sorted(level))
+        done.update(level)
+        remaining.difference_update(level)
+    return result
+
+
+def batches(
+    level: list[str], infos: dict[str, PathInfo], count: int
+) -> list[list[str]]:
+    """Split level into up to count batches of about equal NAR size."""
+    result: list[list[str]] = [[] for _ in range(min(count, len(level)))]
+    sizes = [0] * len(result)
+    for path in sorted(level, key=lambda p: infos[p].narSize, reverse=True):
+        smallest = sizes.index(min(sizes))
+        result[smallest].append(path)
+        sizes[smallest] += infos[path].narSize
+    return result
+
+
+async def push(paths: set[str]) -> bool:
+    """Copy the closures of paths to the cache, True once everything is there."""
+    infos: dict[str, PathInfo] = {}
+    for path in paths:
+        for info in await closures.cache.closure(path):
+            infos[info.path] = info
+    if len(infos) == 0:
+        return True
+    missing = await invalid_on_cache(sorted(infos))
+    if missing is None:
+        return False
+
+    async def send(batch: list[str]) -> bool:
+        narBytes = sum(infos[p].narSize for p in batch)
+        compress = await asyncio.to_thread(compressible, batch) and use_zstd()
+        async with transferSlots:
+            if await transfer(batch, narBytes, compress):
+                return True
+            # The cache might not have zstd, try once more plainly
+            return compress and await transfer(batch, narBytes, False)
+
+    for level in levels(missing, infos):
+        sent = await asyncio.gather(
+            *[send(batch) for batch in batches(level, infos, COPY_JOBS)]
+        )
+        if not all(sent):
+            return False
+    return True
 
 
 async def copyToCache(packagePath: Path):
     # Only run one copy per path per time
-    async with copyLock[packagePath]:
+    async with copyLock(packagePath):
         paths = [str(packagePath)]
-        # Get all paths recursively++
-        pathInfoDrv = await run_captured(
-            "nix",
-            "path-info",
-            "--recursive",
-            "--derivation",
-            packagePath,
-        )
-        if pathInfoDrv.returncode == 0:
-            paths += pathInfoDrv.stdout.splitlines()
+        # Get all paths recursively++ (build inputs through the deriver)
+        try:
+            info = await closures.cache.path_info(packagePath)
+            if info is not None and info.deriver is not None:
+                paths += [i.path for i in await closures.cache.closure(info.deriver)]
+        except (DaemonError, OSError) as ex:
+            logger.debug(f"Querying build inputs of {packagePath} failed {ex}")
 
         # Unique the paths since we're running path-info twice
         paths = list(set(paths))
         # Filter derivation files
         paths = {p for p in paths if not p.endswith(".drv")}
-        if len(paths) > 0:
+        if len(paths) > 0 and CACHE_PULL:
             for _ in range(6):
-                await sleep(5)
-                nixCopy = await run_captured(
-                    "nix", "copy", "--to", "ssh-ng://nix@nix-cache", *paths
-                )
-                if nixCopy.returncode == 0:
-                    logger.debug(nixCopy.combined)
+                if await request_pull(paths):
                     break
+                await sleep(10)
+        elif len(paths) > 0:
+            for _ in range(6):
+                await sleep(5)
+                try:
+                    if await push(paths):
+                        break
+                except (DaemonError, OSError) as ex:
+                    logger.debug(f"Pushing {packagePath} to cache failed {ex}")
                 await sleep(5)
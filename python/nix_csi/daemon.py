@@ -0,0 +1,334 @@
+import asyncio
+import logging
+import os
+import struct
+import time
+from asyncio import Semaphore
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import NamedTuple
+
+logger = logging.getLogger("nix-csi")
+
+# Client for the nix-daemon worker protocol, talks to the local daemon over
+# its unix socket so we don't pay process startup and store open for every
+# store query.
+
+SOCKET_PATH = Path(
+    os.environ.get("NIX_DAEMON_SOCKET_PATH", "/nix/var/nix/daemon-socket/socket")
+)
+
+WORKER_MAGIC_1 = 0x6E697863
+WORKER_MAGIC_2 = 0x6478696F
+PROTOCOL_VERSION = (1 << 8) | 35
+
+STDERR_NEXT = 0x6F6C6D67
+STDERR_READ = 0x64617461
+STDERR_WRITE = 0x64617416
+STDERR_LAST = 0x616C7473
+STDERR_ERROR = 0x63787470
+STDERR_START_ACTIVITY = 0x53545254
+STDERR_STOP_ACTIVITY = 0x53544F50
+STDERR_RESULT = 0x52534C54
+
+WOP_IS_VALID_PATH = 1
+WOP_ENSURE_PATH = 10
+WOP_ADD_TEMP_ROOT = 11
+WOP_QUERY_PATH_INFO = 26
+WOP_QUERY_PATH_FROM_HASH_PART = 29
+WOP_QUERY_VALID_PATHS = 31
+
+# Temporary roots live as long as the daemon connection that added them, so
+# pooled connections are recycled to not pin paths from GC indefinitely.
+CONNECTION_MAX_AGE = 60.0
+
+
+class DaemonError(Exception):
+    """nix-daemon failed an operation or doesn't speak our protocol."""
+
+
+class PathInfo(NamedTuple):
+    path: str
+    deriver: str | None
+    narHash: str
+    references: list[str]
+    registrationTime: int
+    narSize: int
+    ultimate: bool
+    sigs: list[str]
+    ca: str | None
+
+
+class DaemonConnection:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.version = PROTOCOL_VERSION
+        self.opened = time.monotonic()
+
+    @classmethod
+    async def open(cls, path: Path = SOCKET_PATH):
+        reader, writer = await asyncio.open_unix_connection(str(path))
+        conn = cls(reader, writer)
+        try:
+            await conn.handshake()
+        except BaseException:
+            conn.close()
+            raise
+        return conn
+
+    def close(self):
+        self.writer.close()
+
+    def write_int(self, value: int):
+        self.writer.write(struct.pack("<Q", value))
+
+    def write_string(self, value: str | bytes):
+        data = value.encode() if isinstance(value, str) else value
+        self.write_int(len(data))
+        self.writer.write(data + b"\0" * (-len(data) % 8))
+
+    def write_strings(self, values: list[str]):
+        self.write_int(len(values))
+        for value in values:
+            self.write_string(value)
+
+    async def read_int(self) -> int:
+        return struct.unpack("<Q", await self.reader.readexactly(8))[0]
+
+    async def read_string(self) -> str:
+        length = await self.read_int()
+        data = await self.reader.readexactly(length + (-length % 8))
+        return data[:length].decode()
+
+    async def read_strings(self) -> list[str]:
+        return [await self.read_string() for _ in range(await self.read_int())]
+
+    async def read_fields(self):
+        for _ in range(await self.read_int()):
+            if await self.read_int() == 0:
+                await self.read_int()
+            else:
+                await self.read_string()
+
+    def minor(self) -> int:
+        return self.version & 0xFF
+
+    async def handshake(self):
+        self.write_int(WORKER_MAGIC_1)
+        await self.writer.drain()
+        if await self.read_int() != WORKER_MAGIC_2:
+            raise DaemonError("nix-daemon protocol mismatch")
+        daemonVersion = await self.read_int()
+        if daemonVersion >> 8 != PROTOCOL_VERSION >> 8 or daemonVersion & 0xFF < 18:
+            raise DaemonError(f"unsupported nix-daemon protocol {daemonVersion:#x}")
+        self.version = min(daemonVersion, PROTOCOL_VERSION)
+        self.write_int(PROTOCOL_VERSION)
+        # No CPU affinity
+        self.write_int(0)
+        # Obsolete reserveSpace
+        self.write_int(0)
+        await self.writer.drain()
+        if self.minor() >= 33:
+            logger.debug(f"nix-daemon version {await self.read_string()}")
+        if self.minor() >= 35:
+            # Trust status, the daemon enforces it regardless
+            await self.read_int()
+        await self.process_stderr()
+
+    async def process_stderr(self):
+        """Consume log messages until the daemon is done with the operation."""
+        while True:
+            msg = await self.read_int()
+            if msg == STDERR_LAST:
+                return
+            elif msg == STDERR_NEXT:
+                logger.debug(await self.read_string())
+            elif msg == STDERR_WRITE:
+                await self.read_string()
+            elif msg == STDERR_START_ACTIVITY:
+                await self.read_int()  # activity id
+                await self.read_int()  # level
+                await self.read_int()  # type
+                text = await self.read_string()
+                await self.read_fields()
+                await self.read_int()  # parent
+                if text:
+                    logger.debug(text)
+            elif msg == STDERR_STOP_ACTIVITY:
+                await self.read_int()
+            elif msg == STDERR_RESULT:
+                await self.read_int()
+                await self.read_int()
+                await self.read_fields()
+            elif msg == STDERR_ERROR:
+                if self.minor() >= 26:
+                    await self.read_string()  # type, always "Error"
+                    await self.read_int()  # level
+                    await self.read_string()  # name
+                    message = await self.read_string()
+                    await self.read_int()  # position, always 0
+                    for _ in range(await self.read_int()):
+                        await self.read_int()  # position
+                        await self.read_string()  # trace
+                else:
+                    message = await self.read_string()
+                    await self.read_int()  # exit status
+                raise DaemonError(f"nix-daemon: {message}")
+            else:
+                raise DaemonError(f"nix-daemon sent unknown {msg:#x}")
+
+    async def op(self, opcode: int, *args: str | int | list[str]):
+        """Send an operation and wait for the daemon to start replying."""
+        self.write_int(opcode)
+        for arg in args:
+            if isinstance(arg, list):
+                self.write_strings(arg)
+            elif isinstance(arg, int):
+                self.write_int(arg)
+            else:
+                self.write_string(arg)
+        await self.writer.drain()
+        await self.process_stderr()
+
+    async def is_valid_path(self, path: str) -> bool:
+        await self.op(WOP_IS_VALID_PATH, path)
+        return await self.read_int() != 0
+
+    async def query_valid_paths(self, paths: list[str]) -> list[str]:
+        if self.minor() >= 27:
+            # Don't substitute
+            await self.op(WOP_QUERY_VALID_PATHS, paths, 0)
+        else:
+            await self.op(WOP_QUERY_VALID_PATHS, paths)
+        return await self.read_strings()
+
+    async def query_path_info(self, path: str) -> PathInfo | None:
+        await self.op(WOP_QUERY_PATH_INFO, path)
+        if await self.read_int() == 0:
+            return None
+        deriver = await self.read_string()
+        narHash = await self.read_string()
+        references = await self.read_strings()
+        registrationTime = await self.read_int()
+        narSize = await self.read_int()
+        ultimate = await self.read_int() != 0
+        sigs = await self.read_strings()
+        ca = await self.read_string()
+        return PathInfo(
+            path,
+            deriver or None,
+            narHash,
+            references,
+            registrationTime,
+            narSize,
+            ultimate,
+            sigs,
+            ca or None,
+        )
+
+    async def query_path_from_hash_part(self, hashPart: str) -> str | None:
+        await self.op(WOP_QUERY_PATH_FROM_HASH_PART, hashPart)
+        return await self.read_string() or None
+
+    async def add_temp_root(self, path: str):
+        await self.op(WOP_ADD_TEMP_ROOT, path)
+        await self.read_int()
+
+    async def ensure_path(self, path: str):
+        await self.op(WOP_ENSURE_PATH, path)
+        await self.read_int()
+
+
+class DaemonPool:
+    """Bounded pool of daemon connections, reused between operations."""
+
+    def __init__(self, path: Path = SOCKET_PATH, size: int = 4):
+        self.path = path
+        self.slots = Semaphore(size)
+        self.idle: list[DaemonConnection] = []
+
+    @asynccontextmanager
+    async def connection(self):
+        async with self.slots:
+            if len(self.idle) > 0:
+                conn = self.idle.pop()
+            else:
+                conn = await DaemonConnection.open(self.path)
+                # Closed once too old, also if nobody uses it by then
+                asyncio.get_running_loop().call_later(
+                    CONNECTION_MAX_AGE, self.expire, conn
+                )
+            try:
+                yield conn
+            except BaseException:
+                # We don't know where in the stream we are, start over
+                conn.close()
+                raise
+            if time.monotonic() - conn.opened < CONNECTION_MAX_AGE:
+                self.idle.append(conn)
+            else:
+                conn.close()
+
+    def expire(self, conn: DaemonConnection):
+        """Close conn if it's idle, in use it's closed when it's returned."""
+        if conn in self.idle:
+            self.idle.remove(conn)
+            conn.close()
+
+
+pool = DaemonPool()
+
+
+async def is_valid_path(path: Path | str) -> bool:
+    async with pool.connection() as conn:
+        return await conn.is_valid_path(str(path))
+
+
+async def query_path_info(path: Path | str) -> PathInfo | None:
+    async with pool.connection() as conn:
+        return await conn.query_path_info(str(path))
+
+
+async def query_path_from_hash_part(hashPart: str) -> str | None:
+    """Store path whose hash part is hashPart, None if there's no such path."""
+    async with pool.connection() as conn:
+        return await conn.query_path_from_hash_part(hashPart)
+
+
+async def query_closure(path: Path | str) -> list[PathInfo]:
+    """Path infos of path and everything it references, recursively.
+
+    Walks the reference graph one level at a time, spreading each level over
+    the connection pool. Returns an empty list if path isn't valid.
+    """
+    infos: dict[str, PathInfo] = {}
+    frontier = {str(path)}
+    while len(frontier) > 0:
+        results = await asyncio.gather(*[query_path_info(p) for p in frontier])
+        frontier = set()
+        for info in results:
+            if info is None:
+                continue
+            infos[info.path] = info
+            frontier.update(r for r in info.references if r not in infos)
+    return list(infos.values())
+
+
+async def add_temp_root(path: Path | str):
+    async with pool.connection() as conn:
+        await conn.add_temp_root(str(path))
+
+
+async def ensure_path(path: Path | str):
+    async with pool.connection() as conn:
+        await conn.ensure_path(str(path))
+
+
+async def add_perm_root(gcPath: Path, path: Path):
+    """Point gcPath (inside a gcroots directory) at path without racing GC."""
+    await add_temp_root(path)
+    tmpPath = gcPath.with_name(f".{gcPath.name}.tmp")
+    tmpPath.unlink(missing_ok=True)
+    tmpPath.symlink_to(path)
+    tmpPath.rename(gcPath)
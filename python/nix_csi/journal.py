@@ -0,0 +1,114 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+from pathlib import Path
+
+logger = logging.getLogger("nix-csi")
+
+# Publishing a volume goes through phases, each recorded here once done so a
+# retry after a failure or a restart of nix-csi continues where it stopped:
+#
+#   request       fingerprint of the request the phases below belong to
+#   resolved      packagePath the volume attributes resolved to
+#   materialized  closure copied into the volume (or its shared root)
+#   database      Nix database and roots created
+#   mounted       volume mounted at the target path
+#
+# Rows are only appended while publishing, unpublishing drops the volume.
+# Every publish attempt also replaces the volume's "attempt" row. Kubelet
+# doesn't unpublish volumes that never mounted, so those are reaped once
+# nobody attempted to publish them in a while, even if retries keep failing
+# before recording anything.
+
+PHASES = ["request", "resolved", "materialized", "database", "mounted"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS Journal (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    volumeId TEXT NOT NULL,
+    phase TEXT NOT NULL,
+    value TEXT NOT NULL,
+    time INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS JournalVolume ON Journal (volumeId);
+"""
+
+
+def fingerprint(targetPath: str, readonly: bool, volumeContext: dict[str, str]):
+    """Hash of what a publish request asks for, retries must match it."""
+    data = json.dumps([targetPath, readonly, sorted(volumeContext.items())])
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+class PublishJournal:
+    """Completed publish phases per volume, in SQLite on disk."""
+
+    def __init__(self):
+        self.db: sqlite3.Connection | None = None
+
+    def open(self, dbPath: Path):
+        """Record phases in dbPath, nothing is recorded until this is called."""
+        try:
+            dbPath.parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(dbPath, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            # Survives nix-csi crashing, which is what we care about
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript(SCHEMA)
+            self.db = db
+        except sqlite3.Error as ex:
+            logger.warning(f"Publish journal {dbPath} unusable, not resuming {ex}")
+
+    def phases(self, volumeId: str) -> dict[str, str]:
+        """Phases recorded for volumeId, mapped to their values."""
+        if self.db is None:
+            return {}
+        rows = self.db.execute(
+            "SELECT phase, value FROM Journal WHERE volumeId = ? ORDER BY id",
+            (volumeId,),
+        )
+        return dict(rows.fetchall())
+
+    def record(self, volumeId: str, phase: str, value: str = ""):
+        if self.db is None:
+            return
+        assert phase in PHASES
+        self.db.execute(
+            "INSERT INTO Journal (volumeId, phase, value, time) VALUES (?, ?, ?, ?)",
+            (volumeId, phase, value, int(time.time())),
+        )
+
+    def touch(self, volumeId: str):
+        """Record that publishing volumeId is being attempted (again)."""
+        if self.db is None:
+            return
+        self.db.execute(
+            "DELETE FROM Journal WHERE volumeId = ? AND phase = 'attempt'",
+            (volumeId,),
+        )
+        self.db.execute(
+            "INSERT INTO Journal (volumeId, phase, value, time)"
+            " VALUES (?, 'attempt', '', ?)",
+            (volumeId, int(time.time())),
+        )
+
+    def stale(self, olderThan: float) -> list[str]:
+        """Volumes that never mounted and weren't attempted since olderThan."""
+        if self.db is None:
+            return []
+        rows = self.db.execute(
+            "SELECT volumeId FROM Journal GROUP BY volumeId"
+            " HAVING MAX(time) < ? AND SUM(phase = 'mounted') = 0",
+            (int(olderThan),),
+        )
+        return [volumeId for (volumeId,) in rows.fetchall()]
+
+    def forget(self, volumeId: str):
+        if self.db is None:
+            return
+        self.db.execute("DELETE FROM Journal WHERE volumeId = ?", (volumeId,))
+
+
+volumes = PublishJournal()
@@ -1,15 +1,28 @@
 #! /usr/bin/env python3
 
-import kr8s
+# kr8s is imported where it's used, importing it takes longer than the rest
+# of nix-csi together and nodes outside a cluster never need it.
 
+# Nix system -> kubernetes.io/arch
+SYSTEM_ARCH = {
+    "x86_64-linux": "amd64",
+    "aarch64-linux": "arm64",
+}
+
+
+async def get_builder_ips(namespace: str, system: str | None = None) -> list[str]:
+    import kr8s
 
-async def get_builder_ips(namespace: str) -> list[str]:
     candidate_nodes = []
     nodes = kr8s.asyncio.get("nodes")
-    # Get all builder tagged nodes
+    # Get all builder tagged nodes, optionally only those that can build system
     async for node in nodes:
         try:
             node.metadata["labels"]["nix.csi/builder"]
+            if system is not None:
+                arch = node.metadata["labels"]["kubernetes.io/arch"]
+                if SYSTEM_ARCH.get(system) != arch:
+                    continue
             candidate_nodes.append(node.name)
         except KeyError:
             pass
@@ -27,3 +40,19 @@ async def get_builder_ips(namespace: str) -> list[str]:
             pass
 
     return builder_ips
+
+
+async def get_node_ips(namespace: str) -> list[str]:
+    import kr8s
+
+    node_ips = []
+    pods = kr8s.asyncio.get(
+        "pods", namespace=namespace, label_selector={"app": "nix-csi-node"}
+    )
+    async for pod in pods:
+        try:
+            node_ips.append(pod.status["podIP"])
+        except KeyError:
+            pass
+
+    return node_ips
@@ -0,0 +1,91 @@
+import asyncio
+import hashlib
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger("nix-csi")
+
+# Keys longer than this (nixExpr texts) are kept as their SHA-256
+MAX_KEY_LENGTH = 128
+# Waits longer than this are logged with the lock's statistics
+SLOW_WAIT = 5.0
+
+
+class KeyedLock:
+    """Mutexes by key that only exist while they're held or waited for.
+
+    Entries are removed once the last holder releases, so memory follows
+    what's in flight rather than every key ever seen. Waiters are handed
+    the lock in arrival order.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        # key of a held lock -> tasks waiting for it, first come first served
+        self.waiters: dict[str, deque[asyncio.Future]] = {}
+        self.acquired = 0
+        self.contended = 0
+        self.waited = 0.0
+        self.maxWaiters = 0
+
+    @staticmethod
+    def key(key: object) -> str:
+        key = str(key)
+        if len(key) > MAX_KEY_LENGTH:
+            return f"sha256:{hashlib.sha256(key.encode()).hexdigest()}"
+        return key
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "held": len(self.waiters),
+            "waiting": sum(len(w) for w in self.waiters.values()),
+            "acquired": self.acquired,
+            "contended": self.contended,
+            "waited": round(self.waited, 3),
+            "maxWaiters": self.maxWaiters,
+        }
+
+    @asynccontextmanager
+    async def __call__(self, key: object):
+        key = self.key(key)
+        waiters = self.waiters.get(key)
+        if waiters is None:
+            self.waiters[key] = deque()
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            waiters.append(waiter)
+            self.contended += 1
+            self.maxWaiters = max(self.maxWaiters, len(waiters))
+            start = time.perf_counter()
+            try:
+                # The releasing task hands the lock over to us
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    self.release(key)
+                elif waiter in waiters:
+                    waiters.remove(waiter)
+                raise
+            finally:
+                waited = time.perf_counter() - start
+                self.waited += waited
+            if waited > SLOW_WAIT:
+                logger.info(
+                    f"Waited {waited:.1f}s for {self.name} lock {key[:80]} {self.stats()}"
+                )
+        self.acquired += 1
+        try:
+            yield
+        finally:
+            self.release(key)
+
+    def release(self, key: str):
+        waiters = self.waiters[key]
+        while len(waiters) > 0:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        del self.waiters[key]
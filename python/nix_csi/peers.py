@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import os
+import time
+from pathlib import Path
+
+from . import daemon
+from .copytocache import CACHE_PULL
+from .kubernetes import get_node_ips
+
+logger = logging.getLogger("nix-csi")
+
+# Port every node serves its store index on
+PEER_PORT = int(os.environ.get("PEER_PORT", "8180"))
+# How long a node list fetched from the API server is reused
+PEERS_TTL = 30.0
+# How long we wait for a peer to answer before skipping it
+QUERY_TIMEOUT = 1.0
+# Never add more than this many peers as substituters
+MAX_PEERS = 3
+# Peers are preferred over upstream caches (priority 40/50) and nix-cache (20)
+PEER_PRIORITY = 10
+
+# (fetch time, node pod IPs)
+peerCache: tuple[float, list[str]] = (0.0, [])
+
+
+async def handle_index(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    store: Path,
+    pool: daemon.DaemonPool | None,
+):
+    """Answers `HEAD /<store path basename>` with 200 if we hold the path.
+
+    Only paths the daemon has registered count, directories being
+    substituted or left over from a crash don't have their closure.
+    """
+    try:
+        requestLine = await asyncio.wait_for(reader.readline(), QUERY_TIMEOUT)
+        parts = requestLine.decode().split()
+        name = parts[1].lstrip("/") if len(parts) >= 2 else ""
+        # Only plain store path names, no traversal
+        if name == "" or "/" in name or name.startswith("."):
+            status = "400 Bad Request"
+        else:
+            async with (pool or daemon.pool).connection() as conn:
+                valid = await conn.is_valid_path(str(store / name))
+            status = "200 OK" if valid else "404 Not Found"
+        writer.write(f"HTTP/1.0 {status}\r\nContent-Length: 0\r\n\r\n".encode())
+        await writer.drain()
+    except (asyncio.TimeoutError, OSError, UnicodeDecodeError):
+        pass
+    except daemon.DaemonError as ex:
+        logger.debug(f"Store index query failed {ex}")
+    finally:
+        writer.close()
+
+
+async def serve_index(
+    store: Path = Path("/nix/store"),
+    port: int = PEER_PORT,
+    host: str | None = None,
+    pool: daemon.DaemonPool | None = None,
+):
+    """Serve which store paths this node holds to other nodes.
+
+    Validity is asked from the daemon behind pool, the global one if None.
+    """
+    server = await asyncio.start_server(
+        lambda r, w: handle_index(r, w, store, pool), host=host, port=port
+    )
+    logger.info(f"Store index listening on port {port}")
+    return server
+
+
+async def peer_has(ip: str, storePath: Path, port: int = PEER_PORT) -> bool:
+    """Ask the peer at ip if it holds storePath."""
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(ip, port), QUERY_TIMEOUT
+        )
+        try:
+            writer.write(f"HEAD /{storePath.name} HTTP/1.0\r\n\r\n".encode())
+            await writer.drain()
+            statusLine = await asyncio.wait_for(reader.readline(), QUERY_TIMEOUT)
+            return statusLine.split()[1:2] == [b"200"]
+        finally:
+            writer.close()
+    except (asyncio.TimeoutError, OSError):
+        return False
+
+
+async def get_peers() -> list[str]:
+    """nix-csi-node pod IPs, excluding ourselves."""
+    global peerCache
+    namespace = os.environ.get("KUBE_NAMESPACE")
+    if namespace is None:
+        return []
+
+    fetched, peers = peerCache
+    if time.monotonic() - fetched > PEERS_TTL:
+        try:
+            peers = await get_node_ips(namespace)
+        except Exception as ex:
+            logger.warning(f"Failed to list peers {ex}")
+            peers = []
+        peerCache = (time.monotonic(), peers)
+
+    podIP = os.environ.get("KUBE_POD_IP")
+    return [ip for ip in peers if ip != podIP]
+
+
+async def peer_substituters(storePath: Path, port: int = PEER_PORT) -> list[str]:
+    """`nix build` arguments adding peers holding storePath as substituters.
+
+    A valid store path implies its whole closure is valid, so a peer holding
+    the root can substitute everything below it. In pull mode nodes only
+    trust paths signed by nix-cache, peers included, so what a peer built
+    itself isn't taken from it.
+    """
+    peers = await get_peers()
+    if len(peers) == 0:
+        return []
+
+    has = await asyncio.gather(*[peer_has(ip, storePath, port) for ip in peers])
+    holders = [ip for ip, held in zip(peers, has) if held][:MAX_PEERS]
+    logger.debug(f"Peers holding {storePath}: {holders}")
+
+    trusted = "" if CACHE_PULL else "trusted=1&"
+    args = []
+    for ip in holders:
+        args += [
+            "--extra-substituters",
+            f"ssh-ng://nix@{ip}?{trusted}priority={PEER_PRIORITY}",
+        ]
+    return args
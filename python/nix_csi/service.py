@@ -1,10 +1,12 @@
 import asyncio
 import logging
 import os
+import platform
 import shutil
 import socket
 import math
 import tempfile
+import time
 
 from csi import csi_grpc, csi_pb2
 from grpclib import GRPCError
@@ -12,10 +14,13 @@ from grpclib.const import Status
 from grpclib.server import Server
 from importlib import metadata
 from pathlib import Path
-from asyncio import Semaphore, sleep
-from collections import defaultdict
+from asyncio import sleep
 from .identityservicer import IdentityServicer
-from .copytocache import copyToCache
+from .copytocache import CACHE_SUBSTITUTER, copyToCache
+from .builders import remote_build_args
+from .locks import KeyedLock
+from .peers import peer_substituters, serve_index
+from . import admission, closures, composefs, daemon, journal, usage
 from .subprocessing import run_captured, run_console, try_captured, try_console
 
 logger = logging.getLogger("nix-csi")
@@ -31,11 +36,40 @@ NIX_ROOT = Path("/")
 CSI_ROOT = NIX_ROOT / "nix/var/nix-csi"
 CSI_VOLUMES = CSI_ROOT / "volumes"
 CSI_GCROOTS = NIX_ROOT / "nix/var/nix/gcroots/nix-csi"
+# Readonly roots shared between volumes of the same package
+CSI_SHARED = CSI_ROOT / "shared"
 
-RSYNC_CONCURRENCY = Semaphore(1)
+# Volumes whose publish failed and wasn't retried for this long are removed,
+# kubelet doesn't unpublish what never mounted
+STALE_VOLUME_AGE = float(os.environ.get("STALE_VOLUME_AGE", 3600))
+REAP_INTERVAL = 600.0
+
+# rsync: hardlink farm per volume (shared between readonly volumes)
+# composefs: image per package, file contents redirect to the host store
+BACKENDS = ["rsync", "composefs"]
+
+
+# uname machine -> Nix system CPU
+MACHINE_CPU = {
+    "x86_64": "x86_64",
+    "amd64": "x86_64",
+    "aarch64": "aarch64",
+    "arm64": "aarch64",
+    "armv6l": "armv6l",
+    "armv7l": "armv7l",
+    "i686": "i686",
+    "riscv64": "riscv64",
+    "powerpc64le": "powerpc64le",
+}
 
 
 async def get_current_system():
+    """builtins.currentSystem, without starting an evaluator when we can."""
+    cpu = MACHINE_CPU.get(platform.machine())
+    kernel = platform.system().lower()
+    if cpu is not None and kernel in ["linux", "darwin"]:
+        return f"{cpu}-{kernel}"
+    logger.info(f"Unknown platform {platform.machine()}, asking nix")
     return (
         await try_captured(
             "nix", "eval", "--raw", "--impure", "--expr", "builtins.currentSystem"
@@ -49,84 +83,269 @@ def initialize():
     CSI_ROOT.mkdir(parents=True, exist_ok=True)
     CSI_VOLUMES.mkdir(parents=True, exist_ok=True)
     CSI_GCROOTS.mkdir(parents=True, exist_ok=True)
+    CSI_SHARED.mkdir(parents=True, exist_ok=True)
+    closures.cache.open(CSI_ROOT / "closures.sqlite")
+    journal.volumes.open(CSI_ROOT / "journal.sqlite")
+
+
+async def init_state(nixRoot: Path, packagePath: Path, paths: list[str]):
+    """Create the Nix database and roots for paths in nixRoot/var."""
+    # Capitalized to emphasise they're Nix environment variables
+    NIX_STATE_DIR = nixRoot / "var/nix"
+    # Create NIX_STATE_DIR where database will be initialized
+    NIX_STATE_DIR.mkdir(parents=True, exist_ok=True)
+
+    # Create Nix database
+    # This is a bash script that runs nix-store --dump-db | NIX_STATE_DIR=something nix-store --load-db
+    await try_captured(
+        "nix_init_db",
+        NIX_STATE_DIR,
+        *paths,
+    )
 
+    # install gcroots in container, the chroot store finds roots
+    # by reading symlinks in gcroots so a plain symlink is enough.
+    # Auto roots for /nix/var/result would point to Narnia while
+    # this one points into store.
+    (NIX_STATE_DIR / "gcroots").mkdir(parents=True, exist_ok=True)
+    (NIX_STATE_DIR / "gcroots/result").unlink(missing_ok=True)
+    (NIX_STATE_DIR / "gcroots/result").symlink_to(packagePath)
+
+    # install /nix/var/result in container
+    (nixRoot / "var/result").unlink(missing_ok=True)
+    (nixRoot / "var/result").symlink_to(packagePath)
+
+
+async def copy_closure(volumeRoot: Path, paths: list[str], priority: bool = False):
+    """Hardlink paths into volumeRoot/nix/store.
+
+    This is essentially nix copy into a chroot store with extra steps.
+    (Hardlinking instead of dumbcopying)
+    """
+    # Copy closure to substore, rsync saves a lot of implementation
+    # headache here. --archive keeps all attributes, --hard-links
+    # hardlinks everything hardlinkable.
+    async with admission.copies.slot(priority):
+        await try_captured(
+            "rsync",
+            "--one-file-system",
+            "--recursive",
+            "--links",
+            "--hard-links",
+            "--mkpath",
+            *paths,
+            volumeRoot / "nix/store",
+        )
 
-class NodeServicer(csi_grpc.NodeBase):
-    volumeLocks: defaultdict[str, Semaphore] = defaultdict(Semaphore)
-
-    def __init__(self, system: str):
-        self.system = system
 
-    async def NodePublishVolume(self, stream):
-        request: csi_pb2.NodePublishVolumeRequest | None = await stream.recv_message()
-        if request is None:
-            raise ValueError("NodePublishVolumeRequest is None")
+async def materialize(
+    volumeRoot: Path, packagePath: Path, paths: list[str], priority: bool = False
+):
+    """Create volumeRoot/nix holding the closure of packagePath."""
+    await copy_closure(volumeRoot, paths, priority)
+    await init_state(volumeRoot / "nix", packagePath, paths)
+
+
+async def materialize_composefs(
+    sharedRoot: Path, packagePath: Path, paths: list[str], priority: bool = False
+):
+    """Pack the closure of packagePath into an image mounted at sharedRoot/nix."""
+    await init_state(sharedRoot / "state", packagePath, paths)
+    async with admission.copies.slot(priority):
+        image = await composefs.build_image(sharedRoot, paths)
+    await composefs.mount_image(image, sharedRoot / "nix")
+
+
+async def remount_composefs(
+    sharedRoot: Path, packagePath: Path, paths: list[str], priority: bool = False
+):
+    """Mount the image of sharedRoot again, rebuilding it if that fails.
+
+    The image and ready file survive node reboots, the mount doesn't.
+    """
+    image = sharedRoot / "image.cfs"
+    if image.exists():
+        try:
+            await composefs.mount_image(image, sharedRoot / "nix")
+            logger.info(f"Remounted {image}")
+            return
+        except GRPCError as ex:
+            logger.warning(f"Remounting {image} failed, rebuilding it {ex}")
+    # Users of sharedRoot stay registered while it's rebuilt
+    shutil.rmtree(sharedRoot / "state", True)
+    image.unlink(missing_ok=True)
+    await materialize_composefs(sharedRoot, packagePath, paths, priority)
+
+
+async def remove_shared(sharedRoot: Path):
+    # Composefs roots have their image mounted
+    if await NodeServicer.IsMount(sharedRoot / "nix"):
+        await try_captured("umount", "--verbose", sharedRoot / "nix")
+    usage.cache.forget(sharedRoot)
+    shutil.rmtree(sharedRoot, True)
 
-        logger.info(f"Publish {request.target_path}")
 
-        async with self.volumeLocks[request.volume_id]:
-            targetPath = Path(request.target_path)
-            storePath = request.volume_context.get(self.system, None)
-            flakeRef = request.volume_context.get("flakeRef", None)
-            nixExpr = request.volume_context.get("nixExpr", None)
+class NodeServicer(csi_grpc.NodeBase):
+    volumeLocks = KeyedLock("volume")
 
-            packagePath: Path = Path("/nonexistent/path/that/should/never/exist")
-            gcPath = CSI_GCROOTS / request.volume_id
+    def __init__(self, system: str):
+        self.system = system
 
-            try:
-                if os.environ.get("CACHE_ENABLED", "false") == "true":
-                    await asyncio.wait_for(
-                        try_console("ssh", "nix@nix-cache", "--", "true"), timeout=5.0
+    async def nix_build(self, *args):
+        """nix build offloaded to a builder node, falls back to building locally."""
+        async with remote_build_args(self.system) as buildArgs:
+            if len(buildArgs) > 0:
+                result = await run_console("nix", "build", *buildArgs, *args)
+                if result.returncode == 0:
+                    return result
+                logger.warning(
+                    f"Remote build failed, building locally {result.returncode=}"
+                )
+        return await try_console("nix", "build", *args)
+
+    async def acquire_shared(
+        self,
+        volumeRoot: Path,
+        packagePath: Path,
+        paths: list[str],
+        backend: str,
+        priority: bool = False,
+    ):
+        """Link volumeRoot/shared to the shared readonly root of packagePath.
+
+        The shared root is materialized by the first volume using it and
+        removed when the last volume using it is released. Users are tracked
+        as files so references survive restarts.
+        """
+        sharedRoot = CSI_SHARED / f"{packagePath.name}.{backend}"
+        async with self.volumeLocks(str(sharedRoot)):
+            if not (sharedRoot / "ready").exists():
+                await remove_shared(sharedRoot)
+                if backend == "composefs":
+                    await materialize_composefs(
+                        sharedRoot, packagePath, paths, priority
                     )
-                    extraArgs = [
-                        "--extra-substituters",
-                        "ssh-ng://nix@nix-cache?trusted=1&priority=20",
-                    ]
                 else:
-                    extraArgs = []
-            except (GRPCError, OSError, asyncio.TimeoutError) as e:
-                logger.warning(f"Configured SSH cache dysfunctional {e}")
+                    await materialize(sharedRoot, packagePath, paths, priority)
+                (sharedRoot / "ready").touch()
+            elif backend == "composefs" and not await NodeServicer.IsMount(
+                sharedRoot / "nix"
+            ):
+                await remount_composefs(sharedRoot, packagePath, paths, priority)
+            (sharedRoot / "users").mkdir(exist_ok=True)
+            (sharedRoot / "users" / volumeRoot.name).touch()
+            volumeRoot.mkdir(parents=True, exist_ok=True)
+            (volumeRoot / "shared").unlink(missing_ok=True)
+            (volumeRoot / "shared").symlink_to(sharedRoot)
+            logger.debug(f"{volumeRoot.name} shares {sharedRoot}")
+
+    async def release_shared(self, volumeRoot: Path):
+        """Drop volumeRoot's reference to its shared root, removing it if unused."""
+        sharedRoot = Path(os.readlink(volumeRoot / "shared"))
+        (volumeRoot / "shared").unlink()
+        async with self.volumeLocks(str(sharedRoot)):
+            users = sharedRoot / "users"
+            (users / volumeRoot.name).unlink(missing_ok=True)
+            if not users.exists() or not any(users.iterdir()):
+                await remove_shared(sharedRoot)
+                logger.debug(f"removed unused {sharedRoot}")
+
+    async def remove_volume(self, volumeId: str):
+        """Remove the gcroot, state and journal of volumeId, hold its lock."""
+        gcPath = CSI_GCROOTS / volumeId
+        if gcPath.is_symlink():
+            gcPath.unlink()
+            logger.debug(f"unlinked {gcPath=}")
+
+        # Remove hardlink farm, or our reference to a shared one
+        volumePath = CSI_VOLUMES / volumeId
+        if (volumePath / "shared").is_symlink():
+            await self.release_shared(volumePath)
+        usage.cache.forget(volumePath)
+        if volumePath.exists():
+            shutil.rmtree(volumePath)
+            logger.debug(f"removed {volumePath=}")
+
+        journal.volumes.forget(volumeId)
+
+    async def reap_stale(self):
+        """Remove volumes left behind by publishes nobody retried, forever."""
+        while True:
+            for volumeId in journal.volumes.stale(time.time() - STALE_VOLUME_AGE):
+                async with self.volumeLocks(volumeId):
+                    # A publish might have gotten further while we waited
+                    if volumeId not in journal.volumes.stale(
+                        time.time() - STALE_VOLUME_AGE
+                    ):
+                        continue
+                    logger.info(f"Removing {volumeId}, its publish was abandoned")
+                    try:
+                        await self.remove_volume(volumeId)
+                    except OSError as ex:
+                        logger.warning(f"Removing {volumeId} failed {ex}")
+            await sleep(REAP_INTERVAL)
+
+    async def resolve(
+        self, request: csi_pb2.NodePublishVolumeRequest, gcPath: Path, priority: bool
+    ) -> Path:
+        """Build or fetch what the volume attributes describe, returns its path."""
+        storePath = request.volume_context.get(self.system, None)
+        flakeRef = request.volume_context.get("flakeRef", None)
+        nixExpr = request.volume_context.get("nixExpr", None)
+
+        packagePath: Path = Path("/nonexistent/path/that/should/never/exist")
+
+        try:
+            if os.environ.get("CACHE_ENABLED", "false") == "true":
+                await asyncio.wait_for(
+                    try_console("ssh", "nix@nix-cache", "--", "true"), timeout=5.0
+                )
+                extraArgs = ["--extra-substituters", CACHE_SUBSTITUTER]
+            else:
                 extraArgs = []
-
-            if storePath is not None:
-                async with self.volumeLocks[storePath]:
-                    logger.debug(f"{storePath=}")
-                    packagePath = Path(storePath)
-                    if not packagePath.exists():
+        except (GRPCError, OSError, asyncio.TimeoutError) as e:
+            logger.warning(f"Configured SSH cache dysfunctional {e}")
+            extraArgs = []
+
+        if storePath is not None:
+            async with self.volumeLocks(storePath):
+                logger.debug(f"{storePath=}")
+                packagePath = Path(storePath)
+                if not packagePath.exists():
+                    async with admission.builds.slot(priority):
                         await try_console(
                             "nix",
                             "build",
+                            *await peer_substituters(packagePath),
                             *extraArgs,
                             "--out-link",
                             gcPath,
                             packagePath,
                         )
-            elif flakeRef is not None:
-                async with self.volumeLocks[flakeRef]:
-                    logger.debug(f"{flakeRef=}")
+        elif flakeRef is not None:
+            async with self.volumeLocks(flakeRef):
+                logger.debug(f"{flakeRef=}")
 
-                    # Fetch storePath from caches
-                    result = await try_console(
-                        "nix",
-                        "build",
+                # Fetch storePath from caches
+                async with admission.evaluations.slot(priority):
+                    result = await self.nix_build(
                         *extraArgs,
                         "--print-out-paths",
                         "--out-link",
                         gcPath,
                         flakeRef,
                     )
-                    packagePath = Path(result.stdout.splitlines()[0])
-            elif nixExpr is not None:
-                async with self.volumeLocks[nixExpr]:
-                    logger.debug(f"{nixExpr=}")
-                    with tempfile.NamedTemporaryFile(mode="w", suffix=".nix") as tmp:
-                        tmp.write(nixExpr)
-                        tmp.flush()
-
-                        # Fetch storePath from caches
-                        result = await try_console(
-                            "nix",
-                            "build",
+                packagePath = Path(result.stdout.splitlines()[0])
+        elif nixExpr is not None:
+            async with self.volumeLocks(nixExpr):
+                logger.debug(f"{nixExpr=}")
+                with tempfile.NamedTemporaryFile(mode="w", suffix=".nix") as tmp:
+                    tmp.write(nixExpr)
+                    tmp.flush()
+
+                    # Fetch storePath from caches
+                    async with admission.evaluations.slot(priority):
+                        result = await self.nix_build(
                             *extraArgs,
                             "--print-out-paths",
                             "--out-link",
@@ -134,97 +353,120 @@ class NodeServicer(csi_grpc.NodeBase):
                             "--file",
                             tmp.name,
                         )
-                        packagePath = Path(result.stdout.splitlines()[0])
-            else:
-                raise GRPCError(
-                    Status.INVALID_ARGUMENT,
-                    f"Volume doesn't have correct volumeAttributes for {self.system}",
-                )
+                    packagePath = Path(result.stdout.splitlines()[0])
+        else:
+            raise GRPCError(
+                Status.INVALID_ARGUMENT,
+                f"Volume doesn't have correct volumeAttributes for {self.system}",
+            )
+
+        if not packagePath.exists():
+            raise GRPCError(
+                Status.INVALID_ARGUMENT,
+                "packagePath turned out invalid",
+            )
+        return packagePath
 
-            if not packagePath.exists():
+    async def NodePublishVolume(self, stream):
+        request: csi_pb2.NodePublishVolumeRequest | None = await stream.recv_message()
+        if request is None:
+            raise ValueError("NodePublishVolumeRequest is None")
+
+        logger.info(f"Publish {request.target_path}")
+
+        async with self.volumeLocks(request.volume_id):
+            targetPath = Path(request.target_path)
+            backend = request.volume_context.get("backend", "rsync")
+            if backend not in BACKENDS:
                 raise GRPCError(
                     Status.INVALID_ARGUMENT,
-                    "packagePath turned out invalid",
+                    f"Unknown backend {backend}, expected one of {BACKENDS}",
                 )
 
-            # Root directory for volume. Contains /nix, also contains "workdir" and
-            # "upperdir" if we're doing overlayfs
-            volumeRoot = CSI_VOLUMES / request.volume_id
-            # Capitalized to emphasise they're Nix environment variables
-            NIX_STATE_DIR = volumeRoot / "nix/var/nix"
-            # Create NIX_STATE_DIR where database will be initialized
-            NIX_STATE_DIR.mkdir(parents=True, exist_ok=True)
+            # Continue where earlier attempts at the same request stopped
+            requestHash = journal.fingerprint(
+                request.target_path, request.readonly, dict(request.volume_context)
+            )
+            phases = journal.volumes.phases(request.volume_id)
+            if phases.get("request") != requestHash:
+                if "request" in phases:
+                    # Another request under this volume ID, release its state
+                    await self.remove_volume(request.volume_id)
+                phases = {}
+            # Keeps the volume from being reaped while kubelet retries
+            journal.volumes.touch(request.volume_id)
+            if "mounted" in phases and await NodeServicer.IsMount(targetPath):
+                logger.debug(f"{request.volume_id} is already published")
+                reply = csi_pb2.NodePublishVolumeResponse()
+                await stream.send_message(reply)
+                return
+            # Work has been put into this volume, retries go first
+            priority = "resolved" in phases
 
-            # Get closure
-            paths = (
-                await try_captured(
-                    "nix",
-                    "path-info",
-                    "--recursive",
-                    packagePath,
-                )
-            ).stdout.splitlines()
+            gcPath = CSI_GCROOTS / request.volume_id
+            if "resolved" in phases and Path(phases["resolved"]).exists():
+                packagePath = Path(phases["resolved"])
+            else:
+                packagePath = await self.resolve(request, gcPath, priority)
+                journal.volumes.record(request.volume_id, "request", requestHash)
+                journal.volumes.record(request.volume_id, "resolved", str(packagePath))
+                phases = journal.volumes.phases(request.volume_id)
 
+            # Get closure
             try:
-                # This try block is essentially nix copy into a chroot store with
-                # extra steps. (Hardlinking instead of dumbcopying)
-
-                # Install CSI gcroots
-                await try_captured("nix", "build", "--out-link", gcPath, packagePath)
-
-                # Copy closure to substore, rsync saves a lot of implementation
-                # headache here. --archive keeps all attributes, --hard-links
-                # hardlinks everything hardlinkable.
-                async with RSYNC_CONCURRENCY:
-                    await try_captured(
-                        "rsync",
-                        "--one-file-system",
-                        "--recursive",
-                        "--links",
-                        "--hard-links",
-                        "--mkpath",
-                        *paths,
-                        volumeRoot / "nix/store",
-                    )
+                paths = [
+                    info.path for info in await closures.cache.closure(packagePath)
+                ]
+            except daemon.DaemonError as ex:
+                raise GRPCError(Status.INTERNAL, str(ex))
 
-                # Create Nix database
-                # This is a bash script that runs nix-store --dump-db | NIX_STATE_DIR=something nix-store --load-db
-                await try_captured(
-                    "nix_init_db",
-                    NIX_STATE_DIR,
-                    *paths,
-                )
+            # Root directory for volume. Contains /nix, also contains "workdir" and
+            # "upperdir" if we're doing overlayfs. Readonly and composefs
+            # volumes link the root they share in "shared" instead of /nix.
+            volumeRoot = CSI_VOLUMES / request.volume_id
+            shared = request.readonly or backend == "composefs"
 
-                # install gcroots in container using chroot store this is
-                # required because the auto roots created for /nix/var/result
-                # will point to Narnia while this one points into store.
-                await try_captured(
-                    "nix",
-                    "build",
-                    "--store",
-                    volumeRoot,
-                    "--out-link",
-                    NIX_STATE_DIR / "gcroots/result",
-                    packagePath,
-                )
+            try:
+                # Install CSI gcroots
+                await daemon.add_perm_root(gcPath, packagePath)
 
-                # install /nix/var/result in container using chroot store
-                await try_captured(
-                    "nix",
-                    "build",
-                    "--store",
-                    volumeRoot,
-                    "--out-link",
-                    volumeRoot / "nix/var/result",
-                    packagePath,
-                )
+                if shared:
+                    # Cheap once the shared root is ready
+                    await self.acquire_shared(
+                        volumeRoot, packagePath, paths, backend, priority
+                    )
+                    for phase in ["materialized", "database"]:
+                        if phase not in phases:
+                            journal.volumes.record(request.volume_id, phase)
+                else:
+                    if (
+                        "materialized" not in phases
+                        or not (volumeRoot / "nix/store").exists()
+                    ):
+                        await copy_closure(volumeRoot, paths, priority)
+                        journal.volumes.record(request.volume_id, "materialized")
+                        # A fresh copy has no database yet
+                        phases.pop("database", None)
+                    if "database" not in phases:
+                        await init_state(volumeRoot / "nix", packagePath, paths)
+                        journal.volumes.record(request.volume_id, "database")
             except Exception as ex:
-                # Remove gcroots if we failed something else
-                gcPath.unlink(missing_ok=True)
-                # Remove what we were working on
-                shutil.rmtree(volumeRoot, True)
+                # A retry picks up a copied closure, anything less is redone
+                if "materialized" not in journal.volumes.phases(request.volume_id):
+                    # Remove gcroots if we failed something else
+                    gcPath.unlink(missing_ok=True)
+                    # Remove what we were working on
+                    if (volumeRoot / "shared").is_symlink():
+                        await self.release_shared(volumeRoot)
+                    shutil.rmtree(volumeRoot, True)
+                if isinstance(ex, daemon.DaemonError):
+                    raise GRPCError(Status.INTERNAL, str(ex))
                 raise ex
 
+            lowerdir = (
+                volumeRoot / "shared/nix" if shared else volumeRoot / "nix"
+            ).resolve()
+
             targetPath.mkdir(parents=True, exist_ok=True)
             mountCommand = []
             if request.readonly:
@@ -237,7 +479,7 @@ class NodeServicer(csi_grpc.NodeBase):
                     "--bind",
                     "-o",
                     "ro",
-                    volumeRoot / "nix",
+                    lowerdir,
                     targetPath,
                 ]
             else:
@@ -255,7 +497,7 @@ class NodeServicer(csi_grpc.NodeBase):
                     "overlay",
                     "overlay",
                     "-o",
-                    f"rw,lowerdir={volumeRoot / 'nix'},upperdir={upperdir},workdir={workdir}",
+                    f"rw,lowerdir={lowerdir},upperdir={upperdir},workdir={workdir}",
                     targetPath,
                 ]
 
@@ -267,6 +509,7 @@ class NodeServicer(csi_grpc.NodeBase):
                     Status.INTERNAL,
                     f"Failed to mount {mount.returncode=} {mount.stderr=}",
                 )
+            journal.volumes.record(request.volume_id, "mounted")
 
             reply = csi_pb2.NodePublishVolumeResponse()
             await stream.send_message(reply)
@@ -288,7 +531,7 @@ class NodeServicer(csi_grpc.NodeBase):
 
         logger.info(f"Unpublish {request.target_path}")
 
-        async with self.volumeLocks[request.volume_id]:
+        async with self.volumeLocks(request.volume_id):
             targetPath = Path(request.target_path)
 
             # Unmount
@@ -311,27 +554,13 @@ class NodeServicer(csi_grpc.NodeBase):
                         Status.INTERNAL, f"removing {targetPath=} failed", ex
                     )
 
-            # Remove gcroots
-            gcPath = CSI_GCROOTS / request.volume_id
-            if gcPath.exists():
-                try:
-                    gcPath.unlink()
-                    logger.debug(f"unlinked {gcPath=}")
-                except Exception as ex:
-                    raise GRPCError(
-                        Status.INTERNAL, f"unlinking {targetPath=} failed", ex
-                    )
-
-            # Remove hardlink farm
-            volumePath = CSI_VOLUMES / request.volume_id
-            if volumePath.exists():
-                try:
-                    shutil.rmtree(volumePath)
-                    logger.debug(f"removed {volumePath=}")
-                except Exception as ex:
-                    raise GRPCError(
-                        Status.INTERNAL, f"recursive removing {targetPath=} failed", ex
-                    )
+            # Remove gcroots, hardlink farm and journal
+            try:
+                await self.remove_volume(request.volume_id)
+            except Exception as ex:
+                raise GRPCError(
+                    Status.INTERNAL, f"removing {request.volume_id} failed", ex
+                )
 
             reply = csi_pb2.NodeUnpublishVolumeResponse()
             await stream.send_message(reply)
@@ -340,7 +569,15 @@ class NodeServicer(csi_grpc.NodeBase):
         request: csi_pb2.NodeGetCapabilitiesRequest | None = await stream.recv_message()
         if request is None:
             raise ValueError("NodeGetCapabilitiesRequest is None")
-        reply = csi_pb2.NodeGetCapabilitiesResponse(capabilities=[])
+        reply = csi_pb2.NodeGetCapabilitiesResponse(
+            capabilities=[
+                csi_pb2.NodeServiceCapability(
+                    rpc=csi_pb2.NodeServiceCapability.RPC(
+                        type=csi_pb2.NodeServiceCapability.RPC.GET_VOLUME_STATS
+                    )
+                ),
+            ]
+        )
         await stream.send_message(reply)
 
     async def NodeGetInfo(self, stream):
@@ -353,8 +590,44 @@ class NodeServicer(csi_grpc.NodeBase):
         await stream.send_message(reply)
 
     async def NodeGetVolumeStats(self, stream):
-        del stream  # typechecker
-        raise GRPCError(Status.UNIMPLEMENTED, "NodeGetVolumeStats not implemented")
+        request: csi_pb2.NodeGetVolumeStatsRequest | None = await stream.recv_message()
+        if request is None:
+            raise ValueError("NodeGetVolumeStatsRequest is None")
+
+        volumeRoot = CSI_VOLUMES / request.volume_id
+        if not volumeRoot.exists() or not Path(request.volume_path).exists():
+            raise GRPCError(Status.NOT_FOUND, f"Volume {request.volume_id} not found")
+        lowerdir = (
+            volumeRoot / "shared/nix"
+            if (volumeRoot / "shared").is_symlink()
+            else volumeRoot / "nix"
+        ).resolve()
+
+        try:
+            # Closure and upperdir, hardlinked files count once
+            used = await usage.cache.usage(volumeRoot, lowerdir)
+            fs = os.statvfs(volumeRoot)
+        except FileNotFoundError:
+            # Unpublished while we measured, we don't hold the volume's lock
+            raise GRPCError(Status.NOT_FOUND, f"Volume {request.volume_id} not found")
+        reply = csi_pb2.NodeGetVolumeStatsResponse(
+            usage=[
+                csi_pb2.VolumeUsage(
+                    available=fs.f_bavail * fs.f_frsize,
+                    total=fs.f_blocks * fs.f_frsize,
+                    used=used.bytes,
+                    unit=csi_pb2.VolumeUsage.BYTES,
+                ),
+                # Hardlink farms run out of inodes before they run out of bytes
+                csi_pb2.VolumeUsage(
+                    available=fs.f_favail,
+                    total=fs.f_files,
+                    used=used.inodes,
+                    unit=csi_pb2.VolumeUsage.INODES,
+                ),
+            ]
+        )
+        await stream.send_message(reply)
 
     async def NodeExpandVolume(self, stream):
         del stream  # typechecker
@@ -369,10 +642,15 @@ class NodeServicer(csi_grpc.NodeBase):
         raise GRPCError(Status.UNIMPLEMENTED, "NodeUnstageVolume not implemented")
 
 
-async def serve():
-    sock_path = "/csi/csi.sock"
+async def serve(sock_path: str = "/csi/csi.sock"):
     Path(sock_path).unlink(missing_ok=True)
 
+    # Bind first, kubelet and probes queue up on the socket while we start
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(sock_path)
+    sock.listen(128)
+    sock.setblocking(False)
+
     identityServicer = IdentityServicer()
     nodeServicer = NodeServicer(await get_current_system())
     initialize()
@@ -384,11 +662,8 @@ async def serve():
         ]
     )
 
-    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-    sock.bind(sock_path)
-    sock.listen(128)
-    sock.setblocking(False)
-
     await server.start(sock=sock)
     logger.info(f"CSI driver (grpclib) listening on unix://{sock_path}")
-    await server.wait_closed()
+    # Other nodes can wait for our index, kubelet can't wait for us
+    async with await serve_index():
+        await asyncio.gather(server.wait_closed(), nodeServicer.reap_stale())
@@ -4,9 +4,6 @@ import asyncio
 import time
 from typing import NamedTuple
 
-from grpclib import GRPCError
-from grpclib.const import Status
-
 logger = logging.getLogger("nix-csi")
 
 
@@ -21,6 +18,10 @@ class SubprocessResult(NamedTuple):
 async def try_captured(*args):
     result = await run_captured(*args)
     if result.returncode != 0:
+        # Imported here, nix-cache runs commands without serving gRPC
+        from grpclib import GRPCError
+        from grpclib.const import Status
+
         raise GRPCError(
             Status.INTERNAL,
             f"{shlex.join([str(arg) for arg in args[:5]])}... failed: {result.returncode=}",
@@ -32,6 +33,9 @@ async def try_captured(*args):
 async def try_console(*args, log_level: int = logging.DEBUG):
     result = await run_console(*args, log_level=log_level)
     if result.returncode != 0:
+        from grpclib import GRPCError
+        from grpclib.const import Status
+
         raise GRPCError(
             Status.INTERNAL,
             f"{shlex.join([str(arg) for arg in args[:5]])}... failed: {result.returncode=}",
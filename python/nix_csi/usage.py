@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import os
+import stat
+import time
+from pathlib import Path
+from typing import NamedTuple
+
+logger = logging.getLogger("nix-csi")
+
+# Kubelet asks for stats of every volume about once a minute, walking a
+# closure that often would cost more than the workloads. Store paths never
+# change so lowerdirs are walked once, upperdirs are rewalked in the
+# background when kubelet asks for usage older than USAGE_TTL.
+USAGE_TTL = 60.0
+
+
+class Usage(NamedTuple):
+    bytes: int
+    inodes: int
+
+
+class Listing(NamedTuple):
+    mtime: int
+    names: list[str]
+
+
+def disk_bytes(st: os.stat_result) -> int:
+    return st.st_blocks * 512
+
+
+def walk(
+    root: Path,
+    seen: set[tuple[int, int]],
+    previous: dict[str, Listing] | None = None,
+    current: dict[str, Listing] | None = None,
+) -> Usage:
+    """Usage of root counting every inode once, hardlinks included.
+
+    Directory listings from previous are reused for directories whose mtime
+    didn't change, only their entries are stat'ed again. Listings of this
+    walk are put in current.
+    """
+    size = 0
+    inodes = 0
+    stack = [root]
+    while len(stack) > 0:
+        path = stack.pop()
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            continue
+        if (st.st_dev, st.st_ino) in seen:
+            continue
+        seen.add((st.st_dev, st.st_ino))
+        size += disk_bytes(st)
+        inodes += 1
+        if not stat.S_ISDIR(st.st_mode):
+            continue
+        key = str(path)
+        cached = previous.get(key) if previous is not None else None
+        if cached is not None and cached.mtime == st.st_mtime_ns:
+            names = cached.names
+        else:
+            try:
+                names = os.listdir(path)
+            except FileNotFoundError:
+                continue
+        if current is not None:
+            current[key] = Listing(st.st_mtime_ns, names)
+        stack.extend(path / name for name in names)
+    return Usage(size, inodes)
+
+
+class UsageCache:
+    """Volume usage answered from memory, refreshed in the background."""
+
+    def __init__(self):
+        # lowerdir -> usage, closures are immutable
+        self.lowers: dict[str, Usage] = {}
+        # volume root -> upperdir directory -> listing
+        self.listings: dict[str, dict[str, Listing]] = {}
+        # volume root -> (measured at, usage)
+        self.volumes: dict[str, tuple[float, Usage]] = {}
+        self.refreshing: dict[str, asyncio.Task] = {}
+
+    def measure(
+        self, volumeRoot: Path, lowerdir: Path
+    ) -> tuple[Usage, Usage, dict[str, Listing]]:
+        """Walk the volume, runs in a thread so it leaves the caches alone."""
+        lower = self.lowers.get(str(lowerdir))
+        if lower is None:
+            lower = walk(lowerdir, set())
+        listings: dict[str, Listing] = {}
+        upper = walk(
+            volumeRoot / "upperdir",
+            set(),
+            self.listings.get(str(volumeRoot), {}),
+            listings,
+        )
+        return lower, upper, listings
+
+    async def refresh(self, volumeRoot: Path, lowerdir: Path) -> Usage:
+        lower, upper, listings = await asyncio.to_thread(
+            self.measure, volumeRoot, lowerdir
+        )
+        usage = Usage(lower.bytes + upper.bytes, lower.inodes + upper.inodes)
+        self.lowers[str(lowerdir)] = lower
+        self.listings[str(volumeRoot)] = listings
+        self.volumes[str(volumeRoot)] = (time.monotonic(), usage)
+        return usage
+
+    async def usage(self, volumeRoot: Path, lowerdir: Path) -> Usage:
+        """Usage of the volume, measured now only the first time."""
+        key = str(volumeRoot)
+        if key not in self.refreshing:
+            measured, _ = self.volumes.get(key, (-USAGE_TTL, None))
+            if time.monotonic() - measured > USAGE_TTL:
+                task = asyncio.create_task(self.refresh(volumeRoot, lowerdir))
+                self.refreshing[key] = task
+                task.add_done_callback(lambda t: self.refreshed(key, t))
+        if key not in self.volumes:
+            return await asyncio.shield(self.refreshing[key])
+        return self.volumes[key][1]
+
+    def refreshed(self, key: str, task: asyncio.Task):
+        # forget() may have replaced a cancelled refresh with a newer one
+        if self.refreshing.get(key) is task:
+            del self.refreshing[key]
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Measuring {key} failed {task.exception()}")
+
+    def forget(self, root: Path):
+        """Drop everything measured under root, it's being removed."""
+        # lowerdirs are keyed resolved
+        prefixes = {str(root), str(root.resolve())}
+
+        def under(key: str) -> bool:
+            return any(key == p or key.startswith(p + "/") for p in prefixes)
+
+        for key in [k for k in self.refreshing if under(k)]:
+            self.refreshing.pop(key).cancel()
+        for cache in [self.lowers, self.listings, self.volumes]:
+            for key in [k for k in cache if under(k)]:
+                del cache[key]
+
+
+cache = UsageCache()
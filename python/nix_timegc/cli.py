@@ -71,6 +71,25 @@ def delete_paths(paths: list[str], dry_run: bool = False) -> None:
     else:
         print(f"Successfully processed {len(paths)} paths for deletion.")
 
+    forget_closures([path for path in paths if not os.path.lexists(path)])
+
+
+def forget_closures(deleted: list[str]) -> None:
+    """Drop deleted paths from the nix-csi closure cache."""
+    closure_db = (
+        Path(os.environ.get("NIX_CSI_ROOT", "/nix/var/nix-csi")) / "closures.sqlite"
+    )
+    if not deleted or not closure_db.exists():
+        return
+
+    try:
+        with sqlite3.connect(closure_db) as conn:
+            conn.executemany(
+                "DELETE FROM PathInfos WHERE path = ?", [(path,) for path in deleted]
+            )
+    except sqlite3.Error as e:
+        print(f"Failed to prune closure cache: {e}", file=sys.stderr)
+
 
 def main() -> None:
     parser = argparse.ArgumentParser(